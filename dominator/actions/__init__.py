@@ -1,23 +1,26 @@
 import logging
-import logging.config
 import os
-import pkg_resources
 import fnmatch
 import re
 import functools
+import itertools
 import json
 import sys
 import importlib
 import pickle
 
-import yaml
-import mako.template
-from colorama import Fore
+from colorama import Fore, Back, Style
 import click
-import tabloid
 
-from ..entities import SourceImage, BaseShip, BaseFile, Volume, Container, Shipment, LocalShip
+from ..entities import getparents, SourceImage, BaseShip, BaseFile, Volume, ConfigVolume, Container, Shipment, LocalShip
 from .. import utils
+from ..utils.builders import BuilderPool
+from ..utils import snapshot
+
+yaml = utils.lazyimport('yaml')
+mako = utils.lazyimport('mako')
+pkg_resources = utils.lazyimport('pkg_resources')
+tabloid = utils.lazyimport('tabloid')
 
 
 def getlogger():
@@ -26,7 +29,9 @@ def getlogger():
 
 def literal_str_representer(dumper, data):
     return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|' if '\n' in data else None)
-yaml.add_representer(str, literal_str_representer)
+
+
+utils.onload('yaml', lambda yaml: yaml.add_representer(str, literal_str_representer))
 
 
 def validate_loglevel(ctx, param, value):
@@ -52,14 +57,16 @@ def ensure_shipment(shipment):
 
 @click.group()
 @click.option('-s', '--shipment', type=click.Path(), default='./shipment.pickle', show_default=True,
-              help="file to load shipment from/save shipment to")
+              help="file to load shipment from/save shipment to (in compact format if name ends with .snapshot)")
 @click.option('-c', '--config', type=click.File('r'), help="file path to load settings from")
 @click.option('-l', '--loglevel', callback=validate_loglevel, default='warn')
 @click.option('--vcr', type=click.Path(), help="mock all http requests with vcrpy and save cassete")
 @click.option('-o', '--override', multiple=True, help="overide setting from config")
+@click.option('-j', '--jobs', type=int, help="number of objects to process simultaneously")
+@click.option('--per-ship', type=int, help="number of objects to process simultaneously on one ship")
 @click.version_option()
 @click.pass_context
-def cli(ctx, shipment, loglevel, config, vcr, override):
+def cli(ctx, shipment, loglevel, config, vcr, override, jobs, per_ship):
     logging.basicConfig(level=loglevel)
     logging.debug("dominator {} started".format(utils.getversion()))
     utils.settings.load(config)
@@ -67,8 +74,13 @@ def cli(ctx, shipment, loglevel, config, vcr, override):
         assert re.match('[a-z\.\-]+=.*', option), "Options should have format <key=value>, not <{}>".format(option)
         key, value = option.split('=')
         utils.settings[key] = value
+    if jobs is not None:
+        utils.settings['parallel.jobs'] = jobs
+    if per_ship is not None:
+        utils.settings['parallel.pership'] = per_ship
+    from logging.config import dictConfig
     default_logging_config = yaml.load(utils.resource_string('../utils/logging.yaml'))['logging']
-    logging.config.dictConfig(utils.settings.get('logging', default_logging_config))
+    dictConfig(utils.settings.get('logging', default_logging_config))
     logging.disable(level=loglevel-1)
     utils.setcontext(logger=logging.getLogger('dominator'))
 
@@ -79,8 +91,7 @@ def cli(ctx, shipment, loglevel, config, vcr, override):
     if os.path.exists(shipment):
         try:
             utils.getlogger().debug("loading shipment", shipment_filename=shipment)
-            with click.open_file(shipment, 'rb') as file:
-                ctx.obj = pickle.load(file)
+            ctx.obj = snapshot.loadpath(shipment)
             ensure_shipment(ctx.obj)
             if ctx.obj.dominator_version != getshortversion():
                 utils.getlogger().warning("current dominator version {} do not match shipment version {}".format(
@@ -98,9 +109,36 @@ def cli(ctx, shipment, loglevel, config, vcr, override):
         ctx.call_on_close(lambda: cassette.__exit__(None, None, None))
 
 
-@cli.group()
+@cli.group(chain=True)
 def edit():
-    """Commands to edit shipment."""
+    """Commands to edit shipment. Several commands can be chained (e.g. "edit local-ship generate
+    obedient.app"), shipment is saved once after all of them. "generate" and "execute" take all
+    remaining arguments, so they must be the last command in the chain."""
+
+
+@edit.result_callback()
+@click.pass_context
+def save_shipment(ctx, _results):
+    """Save edited shipment if it was changed. File is replaced atomically."""
+    try:
+        filename = ctx.find_root().params['shipment']
+        shipment = ctx.find_root().obj
+        shipment.dominator_version = getshortversion()
+
+        if filename.endswith(snapshot.EXTENSION):
+            data = snapshot.dumps(shipment)
+        else:
+            data = pickle.dumps(shipment)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                if file.read() == data:
+                    utils.getlogger().debug("shipment is not changed", shipment_filename=filename)
+                    return
+        utils.getlogger().debug("saving shipment", shipment_filename=filename)
+        utils.replacefile(filename, data)
+    except Exception as e:
+        getlogger().exception("failed to save shipment")
+        ctx.fail("Failed to save shipment: {!r}".format(e))
 
 
 class InvalidShipmentFile(Exception):
@@ -118,26 +156,18 @@ def edit_subcommand(name=None):
         @click.pass_context
         @functools.wraps(func)
         def wrapper(ctx, *args, **kwargs):
+            # contexts of chained commands are created before any of them is invoked,
+            # so shipment (which could be replaced by previous command) is kept in root context
+            ctx.obj = ctx.find_root().obj
             func(ctx, *args, **kwargs)
-            try:
-                filename = ctx.parent.parent.params['shipment']
-                shipment = ctx.obj
-                utils.getlogger().debug("saving shipment", shipment_filename=filename)
-                shipment.dominator_version = getshortversion()
-
-                data = pickle.dumps(shipment)
-                with click.open_file(filename, 'bw+') as file:
-                    file.write(data)
-            except Exception as e:
-                getlogger().exception("failed to save shipment")
-                ctx.fail("Failed to save shipment: {!r}".format(e))
+            ctx.find_root().obj = ctx.obj
         return wrapper
     return decorator
 
 
 @edit_subcommand()
 def noop(_ctx):
-    """Do nothing and just save the shipment."""
+    """Do nothing and just save the shipment (if it's format or dominator version is changed)."""
 
 
 @edit_subcommand()
@@ -158,7 +188,7 @@ def unload(ctx):
 @click.argument('entrypoint', required=False, metavar='<entrypoint>')
 @click.argument('arguments', nargs=-1, metavar='<arguments>')
 def generate(ctx, distribution, entrypoint, arguments):
-    """Generates yaml config file for shipment."""
+    """Generates yaml config file for shipment. Must be the last command in the chain."""
     if distribution is None:
         click.echo('\n'.join([pkgname for pkgname in pkg_resources.Environment() if pkgname.startswith('obedient.')]))
         ctx.exit()
@@ -194,7 +224,7 @@ def generate(ctx, distribution, entrypoint, arguments):
 @click.argument('function', default='build', metavar='<function>')
 @click.argument('arguments', nargs=-1, metavar='<arguments>')
 def execute(ctx, filename, function, arguments):
-    """Execute function from Python script."""
+    """Execute function from Python script. Must be the last command in the chain."""
     assert filename.endswith('.py'), "Filename should be .py file"
     sys.path.append(os.path.dirname(filename))
     module = importlib.import_module(os.path.basename(filename[:-3]))
@@ -370,39 +400,188 @@ def container(ctx, filter):
     ctx.obj = filter(ctx.obj.containers)
 
 
-def foreach(varname):
+def getship(obj):
+    """Returns ship the object is placed on or None (e.g. for images)."""
+    while obj is not None and not isinstance(obj, BaseShip):
+        obj = getattr(obj, 'ship', None) or getattr(obj, 'container', None) or getattr(obj, 'volume', None)
+    return obj
+
+
+def getjobs(readonly=False):
+    """Returns number of objects to process simultaneously. Read-only commands are parallel by default."""
+    return utils.settings.get('parallel.jobs', 8 if readonly else 1)
+
+
+def foreach(varname, parallel=False, dependencies=None):
+    """Calls decorated function for each object. If `parallel` is set, objects are processed
+    simultaneously according to "parallel.jobs" and "parallel.pership" settings. Objects are
+    processed only after their `dependencies(obj)` (see `utils.parallel`). Without dependencies
+    nothing new is started after the first failure, with them only dependants of failed objects
+    are skipped."""
     def decorator(func):
         @functools.wraps(func)
         def wrapper(objects, *args, **kwargs):
+            def call(obj):
+                with utils.addcontext(**{varname: obj}):
+                    try:
+                        func(obj, *args, **kwargs)
+                    except Exception:
+                        getlogger().exception('error while executing {} on {}'.format(func.__name__, obj))
+                        raise
+
+            jobs = getjobs() if parallel else 1
+            pership = utils.settings.get('parallel.pership', 0)
             with utils.addcontext(logger=logging.getLogger('dominator.'+varname)):
-                for obj in objects:
-                    with utils.addcontext(**{varname: obj}):
-                        try:
-                            func(obj, *args, **kwargs)
-                        except Exception:
-                            getlogger().exception('error while executing {} on {}'.format(func.__name__, obj))
-                            sys.exit(1)
+                failed = False
+                for obj, future in utils.parallel(call, objects, jobs, pership, getship,
+                                                  failfast=dependencies is None, dependencies=dependencies):
+                    exc = future.exception()
+                    if exc is not None and not isinstance(exc, Exception):
+                        raise exc
+                    if isinstance(exc, utils.DependencyError):
+                        getlogger().error('skipping {}: {}'.format(obj, exc))
+                    failed = failed or exc is not None
+                if failed:
+                    sys.exit(1)
         return wrapper
     return decorator
 
 
+def getconfigvolumes(ship, containers):
+    """Returns config volumes of those `containers` that are placed on the `ship`."""
+    return [volume for cont in containers if cont.ship is ship
+            for _, volume in sorted(cont.volumes.items()) if isinstance(volume, ConfigVolume)]
+
+
+def pushmissing(images):
+    """Push those of `images` which registry definitely lacks, all tags are checked at once.
+    Images which could not be checked are left to `BaseImage.deliver` (pulled or pushed on demand)."""
+    from ..utils import registry
+    images = list(images)
+    found = registry.hastags([image.getregistryref() for image in images], getjobs(readonly=True))
+    missing = list({image.getregistryref(): image for image in images
+                    if found[image.getregistryref()] is False}.values())
+    getlogger().info('pushing images missing in registry', count=len(missing), total=len(images))
+    pushimages(missing)
+
+
+@foreach('image', parallel=True)
+def pushimages(image):
+    image.push()
+
+
+def distribute(containers):
+    """Pull images of `containers` to their ships in advance. Ships are checked and images
+    are pulled simultaneously, at most "parallel.perregistry" pulls from one registry at once
+    (see `BaseImage.deliver` for direct transfers). Failures are only logged, `Container.create`
+    tries again later.
+    """
+    transfer = utils.settings.get('images.transfer', 'registry') != 'registry'
+    # different image objects could refer to the same repository and tag
+    pairs = sorted({(cont.ship.fqdn, cont.image.getfullrepository(), cont.image.tag): (cont.ship, cont.image)
+                    for cont in containers}.items())
+    pairs = [pair for _, pair in pairs]
+    ships = sorted(set(ship for ship, _ in pairs))
+    jobs = getjobs(readonly=True)
+
+    def check(ship):
+        with utils.addcontext(ship=ship):
+            return [(s, image) for s, image in pairs if s is ship and not ship.hasimage(image)]
+
+    with utils.addcontext(logger=logging.getLogger('dominator.image')):
+        missing = []
+        for ship, future in utils.parallel(check, ships, jobs):
+            if future.exception() is not None:
+                with utils.addcontext(ship=ship):
+                    getlogger().warning('could not list images: {}'.format(future.exception()))
+            else:
+                missing.extend(future.result())
+
+        if not transfer:
+            # push locally built images once instead of trying to pull them on every ship
+            pushmissing(image for _, image in missing if image.getid() is not None)
+
+        # with direct transfers every local image is read once and streamed to all ships needing it,
+        # others are pulled by each ship separately
+        units = {}
+        for ship, image in missing:
+            key = (image.getfullrepository(), image.tag)
+            if not transfer or image.getid() is None:
+                key = (ship.fqdn,) + key
+            units.setdefault(key, (image, []))[1].append(ship)
+
+        def deliver(unit):
+            image, targets = unit
+            with utils.addcontext(image=image):
+                # local images are already checked (and pushed if missing) by pushmissing,
+                # others could only be pulled anyway
+                image.deliver(targets, check=False)
+
+        perregistry = utils.settings.get('parallel.perregistry', 4)
+        units = [(image, tuple(targets)) for image, targets in units.values()]
+        for (image, targets), future in utils.parallel(deliver, units, jobs, perregistry,
+                                                       lambda unit: unit[0].registry or 'default'):
+            if future.exception() is not None:
+                with utils.addcontext(image=image):
+                    getlogger().warning('could not deliver image to {} in advance: {}'.format(
+                        ', '.join(ship.name for ship in targets), future.exception()))
+
+
+def deploy(containers, restart=False):
+    """Deploy containers in phases: images are pulled to ships in advance, containers are compared
+    with requested config, config volumes of containers to be (re)created are uploaded in one batch
+    per ship, then each container is stopped, removed, created and started in turn. So nothing is
+    stopped until everything else is ready, and at most "parallel.jobs" containers are down at once.
+    Replaced config directories stay mounted into running containers, so they are removed only
+    after the container is recreated.
+    """
+    containers = list(containers)
+    ships = sorted(set(cont.ship for cont in containers))
+    tocreate = set()
+
+    @foreach('ship', parallel=True)
+    def prefetch(ship):
+        ship.prefetch_volumes(getconfigvolumes(ship, containers))
+
+    @foreach('container', parallel=True)
+    def compare(cont):
+        if restart:
+            cont.check()
+            tocreate.add(cont)
+        elif cont.outdated():
+            tocreate.add(cont)
+
+    @foreach('ship', parallel=True)
+    def render(ship):
+        ship.render_volumes(getconfigvolumes(ship, tocreate), keepold=True)
+
+    @foreach('container', parallel=True)
+    def recreate(cont):
+        cont.discard()
+        cont.create(render=False)
+        cont.start()
+        cont.ship.cleanup_volumes(getconfigvolumes(cont.ship, [cont]))
+
+    distribute(containers)
+    if not restart:
+        prefetch(ships)
+    compare(containers)
+    render(ships)
+    recreate([cont for cont in containers if cont in tocreate])
+
+
 @container.command()
 @click.pass_obj
-@foreach('container')
-def start(cont):
+def start(containers):
     """Push images, render config volumes and Start containers."""
-    cont.run()
+    deploy(containers)
 
 
 @container.command()
 @click.pass_obj
-@foreach('container')
-def restart(cont):
+def restart(containers):
     """Restart containers."""
-    cont.check()
-    if cont.running:
-        cont.stop()
-    cont.run()
+    deploy(containers, restart=True)
 
 
 @container.command('exec')
@@ -432,7 +611,7 @@ def common_exec(cont, keep):
 
 @container.command()
 @click.pass_obj
-@foreach('container')
+@foreach('container', parallel=True)
 def stop(cont):
     """Stop container(s) on ship(s)."""
     cont.check()
@@ -443,7 +622,7 @@ def stop(cont):
 @container.command()
 @click.pass_obj
 @click.option('-f', '--force', is_flag=True, default=False, help="Kill and remove container")
-@foreach('container')
+@foreach('container', parallel=True)
 def remove(cont, force):
     """Remove container(s) on ship(s)."""
     cont.check()
@@ -466,35 +645,49 @@ def container_list(container):
 @click.option('-d', '--showdiff', is_flag=True, default=False, help="show diff with running container")
 def status(containers, showdiff):
     """Show container status."""
+    containers = list(containers)
+
+    def getdiff(container):
+        with utils.addcontext(container=container):
+            container.check()
+            if container.running:
+                return list(utils.compare_container(container, container.inspect()))
+
     with utils.addcontext(logger=logging.getLogger('dominator.container')):
         status = 0
-        table = tabloid.FormattedTable()
-        for column in ['name', 'id', 'status']:
-            table.add_column(column)
+        # Rows are printed in the original order as soon as all preceding containers are checked,
+        # so column widths are calculated beforehand
+        rowformat = ' {:{width}} {}{:7} {}{}'
+        width = max([len(container.fullname) for container in containers] + [len('name')])
+        click.echo(Back.GREEN + rowformat.format('name', '', 'id', 'status', '', width=width) + Style.RESET_ALL)
         diffs = {}
-        for i, container in enumerate(containers):
-            with utils.addcontext(container=container):
-                container.check()
+        printed = 0
+
+        @foreach('ship', parallel=True)
+        def prefetch(ship):
+            ship.prefetch_volumes(getconfigvolumes(ship, containers))
+        prefetch(sorted(set(container.ship for container in containers)))
+
+        for container, future in utils.parallel(getdiff, containers, getjobs(readonly=True),
+                                                utils.settings.get('parallel.pership', 0), getship):
+            diffs[container] = future.result()
+            while printed < len(containers) and containers[printed] in diffs:
+                container = containers[printed]
+                diff = diffs.pop(container)
+                printed += 1
                 if container.running:
-                    diff = list(utils.compare_container(container, container.inspect()))
                     if len(diff) > 0:
                         color = Fore.YELLOW
-                        if showdiff:
-                            diffs[i] = '\n'.join(format_diff(diff))
                         status = 2
                     else:
                         color = Fore.GREEN
                 else:
                     color = Fore.RED
                     status = 1
-                table.add_row([container.fullname, color+(container.id or '')[:7], container.status+Fore.RESET])
-
-        header, rows = table.get_table()
-        click.echo(header)
-        for i, row in enumerate(rows.split('\n')):
-            click.echo(row)
-            if i in diffs:
-                click.echo(diffs[i])
+                click.echo(rowformat.format(container.fullname, color, (container.id or '')[:7], container.status,
+                                            Fore.RESET, width=width))
+                if showdiff and diff:
+                    click.echo('\n'.join(format_diff(diff)))
 
         sys.exit(status)
 
@@ -644,24 +837,73 @@ def image(ctx, filter):
     ctx.obj = filter([image for image in ctx.obj.images if isinstance(image, SourceImage)])
 
 
+def iterparents(image):
+    """Iterates over all ancestors of the image."""
+    while isinstance(image, SourceImage):
+        image = image.parent
+        yield image
+
+
 @image.command()
 @click.pass_obj
 @click.option('-n', '--nocache', is_flag=True, default=False, help="disable Docker cache")
 @click.option('-r', '--rebuild', is_flag=True, default=False, help="rebuild image even if alredy built (hashtag found)")
-@foreach('image')
-def build(image, nocache, rebuild):
-    """Build source images."""
-    # image.getid() == None means that image with given tag doesn't exist
-    if rebuild or image.getid() is None:
-        image.build(nocache=nocache)
+@click.option('-b', '--builder', 'builders', multiple=True, help="Docker URL to build images on (could be repeated)")
+@click.option('--on-ships', is_flag=True, default=False, help="build images on shipment ships")
+def build(images, nocache, rebuild, builders, on_ships):
+    """Build source images (independent ones simultaneously with --jobs)."""
+    images = list(images)
+    selected = set(images)
+    # missing parents are built too, each image only once
+    ancestors = [parent for image in images for parent in iterparents(image) if isinstance(parent, SourceImage)]
+    shipment = click.get_current_context().find_root().obj
+    urls = list(builders or utils.settings.get('build.builders', []))
+    if on_ships:
+        urls.extend(ship.url for _, ship in sorted(shipment.ships.items()) if hasattr(ship, 'url'))
+    pool = BuilderPool(urls) if urls else None
+
+    @foreach('image', parallel=True, dependencies=getparents)
+    def buildimage(image):
+        force = rebuild and image in selected
+        if pool is None:
+            # image.getid() == None means that image with given tag doesn't exist
+            if force or image.getid() is None:
+                image.build(nocache=nocache, parents=False)
+        elif force or image.getid() is None:
+            dock = None if force else pool.locate(image)
+            if dock is None:
+                dock = pool.build(image, nocache=nocache)
+            publish(image, dock, shipment)
+
+    buildimage(dict.fromkeys(ancestors + images))
+
+
+def publish(image, dock, shipment):
+    """Deliver image built on builder `dock` to default Docker and either to registry or, if
+    "build.results" setting is "transfer", straight to shipment ships running it.
+    """
+    default = utils.getdocker()
+    if utils.settings.get('build.results', 'push') == 'transfer':
+        ships = sorted(set(cont.ship for cont in itertools.chain(shipment.containers, shipment.tasks.values())
+                           if cont.image is image and cont.ship is not None and cont.ship.docker is not dock))
+        targets = ([default] if default is not dock else []) + [ship for ship in ships if not ship.hasimage(image)]
+        if targets:
+            image.transfer(targets, dock)
+    else:
+        image.push(dock)
+        if default is not dock:
+            image.pull(default, tag=image.tag)
 
 
 @image.command()
 @click.pass_obj
-@foreach('image')
-def push(image):
+@click.option('-f', '--force', is_flag=True, default=False, help="push images even if registry already has them")
+def push(images, force):
     """Push images to Docker registry."""
-    image.push()
+    if force:
+        pushimages(images)
+    else:
+        pushmissing(images)
 
 
 @image.command('list')
@@ -707,7 +949,7 @@ def status_ships(ships):
 
 @ship.command('restart')
 @click.pass_obj
-@foreach('ship')
+@foreach('ship', parallel=True)
 def restart_ship(ship):
     """Restart ship(s)."""
     ship.restart()
@@ -857,7 +1099,7 @@ def dump_config():
 def create_config():
     """(Re)create config files with default values."""
     for filename in ['settings.yaml', 'logging.yaml']:
-        src = pkg_resources.resource_stream('dominator.utils', filename)
+        src = utils.resource_stream(filename, 'dominator.utils')
         dstpath = os.path.join(utils.settings.dirpath, filename)
         if os.path.exists(dstpath):
             if not click.confirm("File {} exists. Are you sure you want to overwrite it?".format(dstpath)):
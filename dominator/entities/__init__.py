@@ -21,18 +21,17 @@ import itertools
 import logging
 import shlex
 import sys
-
-import yaml
-import docker
-import docker.errors
-import mako.template
 import subprocess
 import difflib
-import requests
 
 from .. import utils
 from ..utils import BackrefDict
 
+yaml = utils.lazyimport('yaml')
+docker = utils.lazyimport('docker')
+mako = utils.lazyimport('mako')
+requests = utils.lazyimport('requests')
+
 
 class BaseShip:
     """
@@ -50,6 +49,11 @@ class BaseShip:
     def __repr__(self):
         return '{}(name={})'.format(type(self).__name__, self.name)
 
+    def __getstate__(self):
+        # fields starting with underscore (containers snapshot, transfer caches) are temporary
+        # and should not be saved
+        return {key: value for key, value in vars(self).items() if not key.startswith('_')}
+
     @property
     def logger(self):
         return utils.getlogger()
@@ -61,6 +65,63 @@ class BaseShip:
     def info(self):
         return self.docker.info()
 
+    def getcontainers(self):
+        """Returns {name: cinfo} dict for all Docker containers on the ship.
+        Listing is made once and shared until `invalidate_containers` is called.
+        """
+        with utils.getlock(self):
+            if getattr(self, '_containers', None) is None:
+                self.logger.debug('listing containers on ship')
+                self._containers = {cinfo['Names'][0][1:]: cinfo for cinfo in self.docker.containers(all=True)
+                                    if cinfo['Names']}
+            return self._containers
+
+    def hasimage(self, image):
+        """Returns True if the image tag is already present on the ship."""
+        return image.tag in utils.getimageindex(self.docker).get(image.getfullrepository(), {})
+
+    def loadimage(self, chunks):
+        """Load image from `chunks` of `docker save` output using Docker API."""
+        self.docker.load_image(chunks)
+        utils.invalidate_imageindex(self.docker)
+
+    def invalidate_containers(self):
+        """Drop containers snapshot, should be called after any container change."""
+        with utils.getlock(self):
+            self._containers = None
+
+    def upload_many(self, items, keepold=False):
+        """Upload several directories at once, `items` is a list of (localpath, remotepath)."""
+        for localpath, remotepath in items:
+            self.upload(localpath, remotepath, keepold=keepold)
+
+    def render_volumes(self, volumes, keepold=False):
+        """Render config volumes and upload them to the ship in one batch. If `keepold` is set,
+        replaced directories are kept near new ones (running containers still have them mounted)
+        until `cleanup_volumes` is called.
+        """
+        with tempfile.TemporaryDirectory() as tempdir:
+            items = []
+            for i, volume in enumerate(volumes):
+                localpath = os.path.join(tempdir, str(i))
+                os.mkdir(localpath)
+                with utils.addcontext(volume=volume):
+                    volume.logger.debug('rendering')
+                    volume.dump(localpath)
+                items.append((localpath, volume.fullpath))
+            self.upload_many(items, keepold=keepold)
+
+    def prefetch_volumes(self, volumes):
+        """Prepare to compare many config volumes at once. Does nothing by default."""
+
+    @contextlib.contextmanager
+    def fetch(self, remotepath, files):
+        """Returns local directory containing `files` from `remotepath` on the ship."""
+        with tempfile.TemporaryDirectory() as tempdir:
+            if files:
+                self.download(remotepath, tempdir, files=files)
+            yield tempdir
+
     def place(self, container):
         """Place the container on the ship."""
         assert container.name not in self.containers, "container {} already loaded on the ship".format(container.name)
@@ -97,34 +158,249 @@ class Ship(BaseShip):
         return 'http://{}:{}'.format(self.fqdn, self.port)
 
     @property
-    @utils.cached
     def docker(self):
-        self.logger.debug('connecting to docker api on ship', fqdn=self.fqdn)
-        return docker.Client(self.url)
+        return utils.getdocker(self.url)
 
-    @utils.cached
     def getssh(self):
+        """Returns ssh connection multiplexed over one master connection per ship."""
         self.logger.debug("ssh'ing to ship", fqdn=self.fqdn, login=self.username)
-        import openssh_wrapper
-        conn = openssh_wrapper.SSHConnection(self.fqdn, login=self.username)
-        return conn
+        from ..utils import ssh
+        return ssh.getconnection(self.fqdn, login=self.username, persist=utils.settings.get('ssh.persist', 60))
 
-    def upload(self, localpath, remotepath):
-        """Upload directory recursively to ship using ssh
-        """
-        self.logger.debug("uploading from %s to %s", localpath, remotepath)
-        ssh = self.getssh()
-        ret = ssh.run('rm -rf {0} && mkdir -p {0}'.format(remotepath))
+    def run(self, command):
+        """Run shell command on ship and return it's stdout."""
+        ret = self.getssh().run(command)
         assert ret.returncode == 0, "command execution failed (retcode={}): {}".format(ret.returncode, ret.stderr)
-        ssh.scp([os.path.join(localpath, entry) for entry in os.listdir(localpath)], remotepath)
+        return ret.stdout
+
+    def pipe(self, command, input=None):
+        """Run shell command on ship passing `input` to it's stdin and return it's stdout."""
+        ret = self.getssh().pipe(command, input)
+        assert ret.returncode == 0, "command execution failed (retcode={}): {}".format(ret.returncode, ret.stderr)
+        return ret.stdout
+
+    def readmanifests(self, remotepaths):
+        """Returns content hashes of files stored by previous `upload` to each of `remotepaths`
+        (or None if there is no manifest) using one ssh command.
+        """
+        output = self.run(''.join('if [ -d {} ]; then echo "m $(cat {} 2>/dev/null)"; else echo m; fi\n'.format(
+            shlex.quote(path), shlex.quote(utils.manifestpath(path))) for path in remotepaths))
+        manifests = []
+        for path, line in zip(remotepaths, output.decode().split('\n')):
+            try:
+                manifests.append(json.loads(line[2:]))
+            except ValueError:
+                if line[2:]:
+                    self.logger.warning("invalid manifest found, ignoring", path=path)
+                manifests.append(None)
+        return manifests
+
+    def readmanifest(self, remotepath):
+        """Returns content hashes of files stored by previous `upload` or None."""
+        return self.readmanifests([remotepath])[0]
+
+    def upload(self, localpath, remotepath, keepold=False):
+        """Upload directory recursively to ship using ssh."""
+        self.upload_many([(localpath, remotepath)], keepold=keepold)
+
+    def upload_many(self, items, keepold=False):
+        """Upload several directories at once, `items` is a list of (localpath, remotepath).
+        Only files changed since previous upload are transferred (if "sync.incremental" setting is on).
+        Changed files of all directories are sent in one tar stream into staging directories near
+        remote paths (unchanged files are hard-linked), then staging directories are atomically
+        exchanged with old ones (see `ssh.EXCHANGE`). Old directories are removed, or moved to
+        `remotepath + '.old'` if `keepold` is set (see `cleanup_volumes`).
+        """
+        quote = shlex.quote
+        manifests = [utils.getmanifest(localpath) for localpath, _ in items]
+        remotepaths = [remotepath for _, remotepath in items]
+        oldmanifests = [None] * len(items)
+        if utils.settings.get('sync.incremental', True):
+            with utils.getlock(self):
+                known = dict(getattr(self, '_hashes', {}))
+            unknown = [path for path in remotepaths if path not in known]
+            if unknown:
+                known.update(zip(unknown, self.readmanifests(unknown)))
+            oldmanifests = [known[path] for path in remotepaths]
+
+        from ..utils import ssh
+        prepare, replace, uploads = ['set -e', ssh.EXCHANGE], [], []
+        for (localpath, remotepath), manifest, oldmanifest in zip(items, manifests, oldmanifests):
+            changed = sorted(path for path, digest in manifest.items() if (oldmanifest or {}).get(path) != digest)
+            deleted = sorted(set(oldmanifest or {}) - set(manifest))
+            if oldmanifest is not None and not changed and not deleted:
+                self.logger.debug("directory is up to date, skipping upload", path=remotepath)
+                continue
+            self.logger.debug("uploading changed files", path=remotepath, changed=changed, deleted=deleted)
+            staging, manifestpath = remotepath + '.new', utils.manifestpath(remotepath)
+            prepare.append('rm -rf {staging} && mkdir -p {staging}'.format(staging=quote(staging)))
+            if oldmanifest is not None:
+                # without manifest remote files are unknown, so staging directory is filled from scratch
+                prepare.append('if [ -d {path} ]; then cp -al {path}/. {staging}/; fi && '
+                               '(cd {staging} && rm -f -- {files})'.format(
+                                   staging=quote(staging), path=quote(remotepath),
+                                   files=' '.join(map(quote, changed + deleted))))
+            # staging directory is swapped with the live one, so the path never disappears, but
+            # running containers keep the old one mounted, so it could be kept until they are recreated
+            replace.append('exchange {staging} {path} && mv {manifest}.new {manifest} && {cleanup}'.format(
+                path=quote(remotepath), staging=quote(staging), manifest=quote(manifestpath),
+                cleanup=('rm -rf {old} && if [ -e {staging} ]; then mv -T {staging} {old}; fi' if keepold else
+                         'rm -rf {staging}').format(staging=quote(staging), old=quote(remotepath + '.old'))))
+            uploads.append((localpath, remotepath, manifest, changed))
+        if not uploads:
+            return
+
+        _, tarflags = self.getcompression()
+        with self.sendstream('\n'.join(prepare + [' '.join(['tar -x --no-same-owner -C /'] + tarflags)] + replace)) \
+                as stream, tarfile.open(fileobj=stream, mode='w|') as tar:
+            for localpath, remotepath, manifest, changed in uploads:
+                for path in changed:
+                    tar.add(os.path.join(localpath, path), arcname=os.path.join(remotepath + '.new', path).lstrip('/'))
+                manifestdata = json.dumps(manifest, sort_keys=True).encode()
+                tinfo = tarfile.TarInfo((utils.manifestpath(remotepath) + '.new').lstrip('/'))
+                tinfo.size = len(manifestdata)
+                tar.addfile(tinfo, io.BytesIO(manifestdata))
+        with utils.getlock(self):
+            for _, remotepath, manifest, _ in uploads:
+                self.__dict__.setdefault('_hashes', {})[remotepath] = manifest
+                self.__dict__.setdefault('_fetched', {}).pop(remotepath, None)
+
+    def cleanup_volumes(self, volumes):
+        """Remove old directories of config volumes kept by `render_volumes`."""
+        if volumes:
+            self.run('rm -rf -- ' + ' '.join(shlex.quote(volume.fullpath + '.old') for volume in volumes))
+
+    def getcompression(self):
+        """Returns (remote command compressing stdin, tar options to decompress) for transfers
+        according to "sync.compression" and "sync.compresslevel" settings.
+        """
+        from ..utils import ssh
+        return ssh.getcompression(utils.settings.get('sync.compression', 'none'),
+                                  utils.settings.get('sync.compresslevel', None, type_=int))
+
+    @contextlib.contextmanager
+    def sendstream(self, command):
+        """Start shell `command` on ship and return file-like object streaming (compressed)
+        data to it's stdin.
+        """
+        from ..utils import ssh
+        process = self.getssh().popen(command)
+        progress = ssh.ProgressWriter(process.stdin, self.logger)
+        try:
+            with ssh.compress(progress, utils.settings.get('sync.compression', 'none'),
+                              utils.settings.get('sync.compresslevel', None, type_=int)) as stream:
+                yield stream
+        finally:
+            # if remote command died, closing it's stdin fails, but the command error is more useful
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+            ssh.SSHConnection.check(process)
+        self.logger.debug("upload finished", bytes=progress.bytes)
+
+    def receivetar(self, remotepath, files, localpath):
+        """Stream tar of `files` inside `remotepath` on ship and extract it to `localpath`."""
+        from ..utils import ssh
+        compressor, tarflags = self.getcompression()
+        command = ssh.pipeline('tar -cC {} -- {}'.format(shlex.quote(remotepath), ' '.join(map(shlex.quote, files))),
+                               compressor)
+        process = self.getssh().popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        extract = subprocess.Popen(['tar', '-x', '-C', localpath] + tarflags, stdin=subprocess.PIPE)
+        progress = ssh.ProgressWriter(extract.stdin, self.logger)
+        try:
+            ssh.copystream(process.stdout, progress)
+        finally:
+            extract.stdin.close()
+            process.stdout.close()
+            ssh.SSHConnection.check(process)
+            assert extract.wait() == 0, "tar extraction failed (retcode={})".format(extract.returncode)
+        self.logger.debug("download finished", bytes=progress.bytes)
+
+    def loadimage(self, chunks):
+        """Load image from `chunks` of `docker save` output by streaming them to `docker load`
+        over ssh if "images.transfer" setting is "ssh", otherwise using Docker API.
+        """
+        if utils.settings.get('images.transfer', 'registry') != 'ssh':
+            return super().loadimage(chunks)
+        from ..utils import ssh
+        decompressor = ssh.DECOMPRESSORS[utils.settings.get('sync.compression', 'none')]
+        with self.sendstream(ssh.pipeline(decompressor, 'docker load')) as stream:
+            for chunk in chunks:
+                stream.write(chunk)
+        utils.invalidate_imageindex(self.docker)
+
+    def prefetch_hashes(self, remotepaths):
+        """Calculate hashes for files inside all of `remotepaths` using one ssh command.
+        Results are used by `gethashes` until next upload. If "sync.trustmanifest" setting is on,
+        hashes are taken from manifests stored by `upload` when possible.
+        """
+        hashes = {}
+        if utils.settings.get('sync.trustmanifest', False):
+            hashes = {path: manifest for path, manifest in zip(remotepaths, self.readmanifests(remotepaths))
+                      if manifest is not None}
+        remotepaths = [path for path in remotepaths if path not in hashes]
+        if remotepaths:
+            output = self.run(''.join('(cd {} && find . -type f -exec sha1sum {{}} +) 2>/dev/null; echo ::\n'.format(
+                shlex.quote(path)) for path in remotepaths))
+            lines = iter(output.decode().split('\n'))
+            for path in remotepaths:
+                hashes[path] = {}
+                for line in lines:
+                    if line == '::':
+                        break
+                    digest, filepath = line.split(None, 1)
+                    hashes[path][os.path.normpath(filepath)] = digest
+        with utils.getlock(self):
+            self.__dict__.setdefault('_hashes', {}).update(hashes)
+        return hashes
+
+    def gethashes(self, remotepath):
+        """Returns {relative path: sha1} for all files inside `remotepath` on ship."""
+        with utils.getlock(self):
+            hashes = getattr(self, '_hashes', {}).get(remotepath)
+        if hashes is None:
+            hashes = self.prefetch_hashes([remotepath])[remotepath]
+        return hashes
+
+    def prefetch_files(self, files):
+        """Download files from several directories using one ssh command, `files` is a dict
+        {remotepath: [relative paths]}. Results are used by `download` until next upload.
+        """
+        paths = [os.path.join(remotepath, path).lstrip('/') for remotepath, names in files.items() for path in names]
+        if not paths:
+            return
+        with utils.getlock(self):
+            if getattr(self, '_cachedir', None) is None:
+                self._cachedir = tempfile.TemporaryDirectory()
+            cachedir = self._cachedir.name
+        self.receivetar('/', paths, cachedir)
+        with utils.getlock(self):
+            fetched = self.__dict__.setdefault('_fetched', {})
+            for remotepath, names in files.items():
+                fetched.setdefault(remotepath, set()).update(names)
+
+    def prefetch_volumes(self, volumes):
+        """Fetch hashes and changed files of all config volumes in one batch, so
+        following `compare_files` calls don't access the ship.
+        """
+        hashes = self.prefetch_hashes([volume.fullpath for volume in volumes])
+        self.prefetch_files({volume.fullpath: [name for name in volume.getchanged(hashes[volume.fullpath])
+                                               if os.path.normpath(name) in hashes[volume.fullpath]]
+                             for volume in volumes})
 
-    def download(self, remotepath, localpath):
-        """Download directory recursively from ship using ssh
+    def download(self, remotepath, localpath, files=None):
+        """Download directory recursively (or only `files` from it) from ship using ssh
         """
+        with utils.getlock(self):
+            fetched = getattr(self, '_fetched', {}).get(remotepath, set())
+        if files is not None and fetched.issuperset(files):
+            self.logger.debug("copying prefetched files from %s to %s", remotepath, localpath)
+            for path in files:
+                os.makedirs(os.path.dirname(os.path.join(localpath, path)), exist_ok=True)
+                shutil.copy(os.path.join(self._cachedir.name, remotepath.lstrip('/'), path),
+                            os.path.join(localpath, path))
+            return
         self.logger.debug("downloading from %s to %s", remotepath, localpath)
-        ssh = self.getssh()
-        tar = ssh.run('tar -cC {} .'.format(remotepath)).stdout
-        subprocess.check_output('tar -x -C {}'.format(localpath), input=tar, shell=True)
+        self.receivetar(remotepath, files or ['.'], localpath)
 
     def spawn(self, command, sudo=False):
         ssh = self.getssh()
@@ -172,9 +448,8 @@ class LocalShip(BaseShip):
             return psutil.virtual_memory().total
 
     @property
-    @utils.cached
     def docker(self):
-        return docker.Client(utils.settings.get('docker.url', None))
+        return utils.getdocker()
 
     @property
     def datadir(self):
@@ -184,17 +459,66 @@ class LocalShip(BaseShip):
     def configdir(self):
         return utils.settings['configvolumedir']
 
-    def upload(self, localpath, remotepath):
-        """Upload directory recursively to localship using shutil
+    def replace(self, remotepath, files, keepold=False):
+        """Build staging directory near `remotepath` and atomically swap it in. `files` is
+        {relative path: (sha1, function writing file to given path)}, files with the same content
+        as current ones are hard-linked instead of writing. Old directory is kept if `keepold`
+        is set (see `utils.replacedir`).
         """
-        shutil.rmtree(remotepath, ignore_errors=True)
-        shutil.copytree(localpath, remotepath)
+        current = utils.getmanifest(remotepath) if os.path.isdir(remotepath) else None
+        if current == {path: digest for path, (digest, _) in files.items()}:
+            self.logger.debug("directory is up to date, skipping", path=remotepath)
+            return
+        staging = remotepath + '.new'
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        for path, (digest, write) in files.items():
+            target = os.path.join(staging, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if current and current.get(path) == digest:
+                os.link(os.path.join(remotepath, path), target)
+            else:
+                write(target)
+        utils.replacedir(staging, remotepath, keepold=keepold)
+
+    def upload(self, localpath, remotepath, keepold=False):
+        """Upload directory recursively to localship (see `replace`)."""
+        self.replace(remotepath, {path: (digest, functools.partial(shutil.copy, os.path.join(localpath, path)))
+                                  for path, digest in utils.getmanifest(localpath).items()}, keepold=keepold)
+
+    def render_volumes(self, volumes, keepold=False):
+        """Render config volumes straight into staging directories near target ones (see `replace`)."""
+        for volume in volumes:
+            with utils.addcontext(volume=volume):
+                volume.logger.debug('rendering')
+                self.replace(volume.fullpath, {
+                    os.path.normpath(name): (hashlib.sha1(file.data.encode()).hexdigest(), file.dump)
+                    for name, file in volume.files.items()}, keepold=keepold)
+
+    def cleanup_volumes(self, volumes):
+        """Remove old directories of config volumes kept by `render_volumes`."""
+        for volume in volumes:
+            shutil.rmtree(volume.fullpath + '.old', ignore_errors=True)
+
+    @contextlib.contextmanager
+    def fetch(self, remotepath, files):
+        """Files are read right from `remotepath` without copying."""
+        yield remotepath
+
+    def gethashes(self, remotepath):
+        """Returns {relative path: sha1} for all files inside `remotepath`."""
+        return utils.getmanifest(remotepath)
 
-    def download(self, remotepath, localpath):
-        """Download directory recursively from localship using shutil
+    def download(self, remotepath, localpath, files=None):
+        """Download directory recursively (or only `files` from it) from localship using shutil
         """
-        shutil.rmtree(localpath, ignore_errors=True)
-        shutil.copytree(remotepath, localpath)
+        if files is None:
+            shutil.rmtree(localpath, ignore_errors=True)
+            shutil.copytree(remotepath, localpath)
+        else:
+            for path in files:
+                os.makedirs(os.path.dirname(os.path.join(localpath, path)), exist_ok=True)
+                shutil.copy(os.path.join(remotepath, path), os.path.join(localpath, path))
 
     def spawn(self, command, sudo=False):
         i = utils.PtyInterceptor()
@@ -241,10 +565,16 @@ class BaseImage:
     def logger(self):
         return utils.getlogger()
 
+    def getregistryref(self):
+        """Returns (registry, repository name, tag) used to check the image in registry."""
+        from ..utils import registry
+        return self.registry, registry.getname(self.namespace, self.repository, self.registry), self.tag
+
     @utils.cached
-    def getid(self):
+    def getid(self, dock=None):
+        """Returns id of the image tag in Docker `dock` (default one if not given) or None."""
         self.logger.debug('retrieving id')
-        imageid = self.gettags(None).get(self.tag)
+        imageid = self.gettags(dock).get(self.tag)
         if imageid is None:
             self.logger.warning("could not find tag for image", tag=self.tag)
         return imageid
@@ -269,34 +599,95 @@ class BaseImage:
         dock = dock or utils.getdocker()
         self._streamoperation(dock.push, repository=self.getfullrepository(), tag=self.tag,
                               insecure_registry=utils.settings.get('docker.registry.insecure', False))
+        utils.invalidate_imageindex(dock)
 
     def pull(self, dock=None, tag=None):
         self.logger.info("pulling repo")
         dock = dock or utils.getdocker()
         self._streamoperation(dock.pull, repository=self.getfullrepository(), tag=tag,
                               insecure_registry=utils.settings.get('docker.registry.insecure', False))
-        Image.gettags.cache_clear()
-        Image.getid.cache_clear()
+        utils.invalidate_imageindex(dock)
+        self.invalidate_ids()
+
+    def deliver(self, ships, check=True):
+        """Put the image tag to all `ships`. If "images.transfer" setting is "api" or "ssh" and the
+        image is built locally, it's streamed to ships directly (see `transfer`). Otherwise it's
+        pulled. If `check` is set, registry is checked first and the image is pushed if registry
+        definitely lacks it. If registry could not be checked (or `check` is not set, e.g. the tag
+        was already checked by caller), pull is tried first and the image is pushed only if pull
+        fails and the image exists locally.
+        """
+        if utils.settings.get('images.transfer', 'registry') != 'registry' and self.getid() is not None:
+            self.transfer(ships)
+            return
+        found = None
+        if check:
+            from ..utils import registry
+            found = registry.hastags([self.getregistryref()])[self.getregistryref()]
+        if found is None:
+            try:
+                for ship in ships:
+                    self.pull(ship.docker, tag=self.tag)
+                return
+            except docker.errors.DockerException as e:
+                if self.getid() is None:
+                    raise
+                self.logger.info("could not pull image, pushing repo", error=str(e))
+        elif found is False:
+            self.logger.info("could not find requested image in registry, pushing repo")
+        if not found:
+            with utils.getlock(self):
+                self.push()
+        for ship in ships:
+            self.pull(ship.docker, tag=self.tag)
+
+    def transfer(self, targets, dock=None):
+        """Stream the image from Docker `dock` (`docker save`) to all `targets` (ships or Docker
+        clients) at once (`docker load`), the image is read from `dock` only once.
+        """
+        from ..utils import ssh
+        dock = dock or utils.getdocker()
+        self.logger.info("transferring image", targets=targets)
+
+        def getloader(target):
+            if isinstance(target, BaseShip):
+                return target.loadimage
+
+            def load(chunks):
+                target.load_image(chunks)
+                utils.invalidate_imageindex(target)
+            return load
+
+        source = dock.get_image('{}:{}'.format(self.getfullrepository(), self.tag))
+        try:
+            futures = utils.fanout(iter(functools.partial(source.read, ssh.CHUNKSIZE), b''),
+                                   [getloader(target) for target in targets])
+        finally:
+            source.close()
+        self.invalidate_ids()
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
 
     def build(self, dock=None, **kwargs):
         self.logger.info("building image")
         dock = dock or utils.getdocker()
         self._streamoperation(dock.build, tag='{}:{}'.format(self.getfullrepository(), self.tag), **kwargs)
-        Image.gettags.cache_clear()
-        Image.getid.cache_clear()
+        utils.invalidate_imageindex(dock)
+        self.invalidate_ids()
+
+    def invalidate_ids(self):
+        """Drop cached ids of all images from the same repository after it's tags are changed."""
+        repository = self.getfullrepository()
+        BaseImage.getid.clear(lambda image: image.getfullrepository() == repository)
 
-    @utils.cached
-    @utils.asdict
     def gettags(self, dock):
-        self.logger.debug("retrieving tags")
+        """Returns {tag: id} for the image repository using image index shared by all images."""
         dock = dock or utils.getdocker()
-        images = dock.images(self.getfullrepository(), all=True)
-        for image in images:
-            for tag in image['RepoTags']:
-                yield tag.split(':')[-1], image['Id']
+        return dict(utils.getimageindex(dock).get(self.getfullrepository(), {}))
 
     def inspect(self):
-        result = utils.getdocker().inspect_image(self.getid())
+        result = utils.inspectimage(self.getid())
         # Workaround: Docker sometimes returns "config" key in different casing
         assert 'config' in result or 'Config' in result, "unexpected response from Docker"
         return result['config'] if 'config' in result else result['Config']
@@ -349,6 +740,11 @@ def convert_fileobj(path, fileobj_or_data):
     return tinfo.get_info(), data
 
 
+def getparents(image):
+    """Returns list of images the image is built from."""
+    return [image.parent] if isinstance(image, SourceImage) else []
+
+
 class SourceImage(BaseImage):
     def __init__(self, name: str, parent: Image, scripts: list=None, command: str=None, workdir: str=None,
                  env: dict=None, volumes: dict=None, ports: dict=None, files: dict=None, user: str='',
@@ -366,14 +762,39 @@ class SourceImage(BaseImage):
         self.files = {path: convert_fileobj(path, fileobj_or_data) for path, fileobj_or_data in (files or {}).items()}
         super().__init__(namespace=DEFAULT_NAMESPACE, repository=name, registry=DEFAULT_REGISTRY)
 
-    def build(self, dock=None, **kwargs):
+    def build(self, dock=None, parents=True, **kwargs):
+        """Build the image. If `parents` is set, missing parent source images are built first."""
         self.logger.info("building source image")
-        if isinstance(self.parent, SourceImage):
+        if parents and isinstance(self.parent, SourceImage) and self.parent.getid(dock) is None:
             self.parent.build(dock, **kwargs)
-        return Image.build(self, dock, fileobj=self.gettarfile(), custom_context=True, **kwargs)
+        compress = utils.settings.get('build.compress', False)
+        with contextlib.closing(self.gettarfile(compress, dock)) as context:
+            return Image.build(self, dock, fileobj=context, custom_context=True,
+                               encoding='gzip' if compress else None, **kwargs)
+
+    def __getstate__(self):
+        # fields starting with underscore (tag cache) are temporary and should not be saved
+        return {key: value for key, value in vars(self).items() if not key.startswith('_')}
+
+    def getsignature(self):
+        """Returns cheap snapshot of attributes the tag depends on. Source parent image is
+        represented by it's (cached) tag to avoid walking the whole chain.
+        """
+        state = self.__getstate__()
+        parent = state.pop('parent')
+        parentstate = parent.tag if isinstance(parent, SourceImage) else utils.freeze(vars(parent))
+        return utils.freeze(state), type(parent), parentstate
 
     @property
     def tag(self):
+        """Tag for image calculated from it's attributes, recalculated only when they change"""
+        signature = self.getsignature()
+        cached = getattr(self, '_tag', None)
+        if cached is None or cached[0] != signature:
+            cached = self._tag = signature, self.calculatetag()
+        return cached[1]
+
+    def calculatetag(self):
         """Calculate tag for image from it's attributes"""
         dump = yaml.dump(self)
         digest = hashlib.sha1(dump.encode()).digest()
@@ -383,11 +804,48 @@ class SourceImage(BaseImage):
             tag = tag[1:] + tag[0]
         return tag
 
-    def gettarfile(self):
-        f = tempfile.NamedTemporaryFile()
-        with tarfile.open(mode='w', fileobj=f) as tfile:
+    def gettarfile(self, compress=False, dock=None):
+        """Returns build context as file from content-addressed cache ("build.cache" setting) or,
+        if cache is disabled (default), as generator of chunks streamed to Docker without temporary file.
+        Least recently used contexts are evicted when cache exceeds "build.cachesize" megabytes.
+        """
+        cachedir = utils.settings.get('build.cache', None)
+        if cachedir is None:
+            return self.itertarfile(compress, dock)
+        cachedir = os.path.expanduser(cachedir)
+        key = hashlib.sha1('{}:{}'.format(self.tag, self.parent.getid(dock)).encode()).hexdigest()
+        path = os.path.join(cachedir, key + ('.tar.gz' if compress else '.tar'))
+        if os.path.exists(path):
+            self.logger.debug("using cached build context", path=path)
+            os.utime(path)
+        else:
+            os.makedirs(cachedir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=cachedir, prefix='.', delete=False) as f:
+                try:
+                    for chunk in self.itertarfile(compress, dock):
+                        f.write(chunk)
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+            os.replace(f.name, path)
+            utils.evictfiles(cachedir, utils.settings.get('build.cachesize', 1024) * 2**20, keep=path)
+        return open(path, 'rb')
+
+    def itertarfile(self, compress=False, dock=None):
+        """Generate build context (tar with Dockerfile and files) by chunks, optionally gzipped.
+        Parent image id is taken from Docker `dock` the image is built on.
+        """
+        f = io.BytesIO()
+
+        def flush():
+            data = f.getvalue()
+            f.seek(0)
+            f.truncate()
+            return data
+
+        with tarfile.open(mode='w|gz' if compress else 'w|', fileobj=f) as tfile:
             dockerfile = io.BytesIO()
-            dockerfile.write('FROM {}:{}\n'.format(self.parent.getfullrepository(), self.parent.getid()).encode())
+            dockerfile.write('FROM {}:{}\n'.format(self.parent.getfullrepository(), self.parent.getid(dock)).encode())
             for name, value in self.env.items():
                 dockerfile.write('ENV {} {}\n'.format(name, value).encode())
             if self.workdir is not None:
@@ -421,13 +879,12 @@ class SourceImage(BaseImage):
                 for k, v in tinfo.items():
                     setattr(tarinfo, k, v)
                 tfile.addfile(tarinfo, data)
+                yield flush()
             dfinfo = tarfile.TarInfo('Dockerfile')
             dfinfo.size = len(dockerfile.getvalue())
             dockerfile.seek(0)
             tfile.addfile(dfinfo, dockerfile)
-
-        f.seek(0)
-        return f
+        yield flush()
 
     def getports(self):
         return self.ports
@@ -487,15 +944,12 @@ class Container:
 
     def check(self, cinfo=None):
         """This function tries to find container on the associated ship
-        by listing all containers. If found, it fills `id` and `status` attrs.
+        using ship's containers snapshot. If found, it fills `id` and `status` attrs.
         If `cinfo` is provided, then skips docker api call for container listing.
         """
         if cinfo is None:
             self.logger.debug('checking container status')
-            matched = [cont for cont in self.ship.docker.containers(all=True)
-                       if cont['Names'] and cont['Names'][0][1:] == self.dockername]
-            if len(matched) > 0:
-                cinfo = matched[0]
+            cinfo = self.ship.getcontainers().get(self.dockername)
 
         if cinfo:
             # Custom cinfo could provide only one of (id, state), so
@@ -514,6 +968,7 @@ class Container:
                 raise
             else:
                 # Container already exists
+                self.ship.invalidate_containers()
                 self.check()
                 self.remove(force=True)
                 self.create()
@@ -560,6 +1015,7 @@ class Container:
     def stop(self):
         self.logger.debug('stopping container')
         self.ship.docker.stop(self.id, timeout=2)
+        self.ship.invalidate_containers()
         self.check({'Status': 'stopped'})
 
     def remove(self, force=False):
@@ -567,6 +1023,7 @@ class Container:
         try:
             self.ship.docker.remove_container(self.id, force=force)
         except docker.errors.APIError as e:
+            self.ship.invalidate_containers()
             if any(re.search(pattern, e.explanation) for pattern in [
                 b'Driver devicemapper failed to remove root filesystem',
                 b'Unable to remove filesystem for .* directory not empty'
@@ -577,15 +1034,19 @@ class Container:
                     self.ship.docker.remove_container(self.id, force=force)
             else:
                 raise
+        self.ship.invalidate_containers()
         self.check({'Id': None, 'Status': 'not found'})
 
-    def create(self):
-        """Try to create container. If image is not found, then try to pull or even push it first."""
+    def create(self, render=True):
+        """Try to create container. If image is not found, then try to pull or even push it first.
+        If `render` is False, volumes are expected to be already rendered.
+        """
         with utils.addcontext(image=self.image):
             self.logger.debug('preparing to create container')
 
-            for _, volume in sorted(self.volumes.items()):
-                volume.render(self)
+            if render:
+                for _, volume in sorted(self.volumes.items()):
+                    volume.render(self)
 
             try:
                 cinfo = self._create()
@@ -593,21 +1054,11 @@ class Container:
                 if e.response.status_code != 404:
                     raise
                 # image not found - pull repo and try again
-                # Check if ship has needed image
                 self.logger.info('could not find requested image, pulling repo')
-                try:
-                    self.image.pull(self.ship.docker, tag=self.image.tag)
-                except docker.errors.DockerException as e:
-                    if not any([re.search(pattern, str(e)) for pattern in [
-                            'HTTP code: 404',
-                            'Tag .* not found in repository',
-                            'Error: image .* not found']]):
-                        raise
-                    self.logger.info("could not find requested image in registry, pushing repo")
-                    self.image.push()
-                    self.image.pull(self.ship.docker, tag=self.image.tag)
+                self.image.deliver([self.ship])
                 cinfo = self._create()
 
+            self.ship.invalidate_containers()
             self.check(cinfo)
             self.logger.debug('container created')
 
@@ -628,24 +1079,41 @@ class Container:
             entrypoint=self.entrypoint,
         )
 
-    def run(self):
+    def prepare(self):
+        """Stop and remove existing container if it's config differs from requested.
+        Returns True if container should be (re)created.
+        """
+        if not self.outdated():
+            return False
+        self.discard()
+        return True
+
+    def outdated(self):
+        """Returns True if container is not running or it's config differs from requested."""
         self.check()
+        if not self.running:
+            return True
+        self.logger.info('found running container with the same name, comparing config with requested')
+        diff = utils.compare_container(self, self.inspect())
+        if diff:
+            self.logger.info('running container config differs from requested', diff=diff)
+            return True
+        self.logger.info('running container config identical to requested, keeping')
+        return False
+
+    def discard(self):
+        """Stop and remove existing container (if any)."""
         if self.running:
-            self.logger.info('found running container with the same name, comparing config with requested')
-            diff = utils.compare_container(self, self.inspect())
-            if diff:
-                self.logger.info('running container config differs from requested, stopping', diff=diff)
-                self.stop()
-            else:
-                self.logger.info('running container config identical to requested, keeping')
-                return
-
+            self.logger.info('stopping running container')
+            self.stop()
         if self.id:
             self.logger.info('found stopped container with the same name, removing')
             self.remove()
 
-        self.create()
-        self.start()
+    def run(self):
+        if self.prepare():
+            self.create()
+            self.start()
 
     def start(self):
         self.logger.debug('starting container')
@@ -678,6 +1146,7 @@ class Container:
             else:
                 raise
 
+        self.ship.invalidate_containers()
         self.check({'Status': 'Up'})
         self.logger.debug('container started')
 
@@ -893,19 +1362,30 @@ class ConfigVolume(Volume):
     def ro(self):
         return True
 
+    def dump(self, path):
+        """Write all volume files into local directory."""
+        for name, file in self.files.items():
+            file.dump(os.path.join(path, name))
+
     def render(self, container):
-        self.logger.debug('rendering')
-        with tempfile.TemporaryDirectory() as tempdir:
-            for name, file in self.files.items():
-                file.dump(os.path.join(tempdir, name))
-            container.ship.upload(tempdir, self.fullpath)
+        container.ship.render_volumes([self])
+
+    def getchanged(self, hashes):
+        """Returns names of files which content differs from `hashes` ({path: sha1})."""
+        return [name for name, file in self.files.items()
+                if hashes.get(os.path.normpath(name)) != hashlib.sha1(file.data.encode()).hexdigest()]
 
     @utils.aslist
     def compare_files(self):
+        """Compare files with ones on the ship. Only files with different content hashes are downloaded."""
         self.logger.debug('comparing files')
-        with tempfile.TemporaryDirectory() as tempdir:
-            self.container.ship.download(self.fullpath, tempdir)
-            for name, file in self.files.items():
+        ship = self.container.ship
+        hashes = ship.gethashes(self.fullpath)
+        changed = self.getchanged(hashes)
+        found = [name for name in changed if os.path.normpath(name) in hashes]
+        with ship.fetch(self.fullpath, found) as tempdir:
+            for name in changed:
+                file = self.files[name]
                 self.logger.debug("comparing file", file=file)
                 try:
                     actual = file.load(os.path.join(tempdir, name))
@@ -1041,15 +1521,6 @@ class Shipment:
     @property
     def images(self):
         """Iterates over SourceImages in build order (parent then child etc.)."""
-        def compare_source_images(x, y):
-            if isinstance(x, SourceImage):
-                if x.parent is y:
-                    return 1
-            if isinstance(y, SourceImage):
-                if x is y.parent:
-                    return -1
-            return 0
-
         def iterate_images():
             for container in itertools.chain(self.containers, self.tasks.values()):
                 image = container.image
@@ -1060,7 +1531,7 @@ class Shipment:
                     else:
                         break
 
-        return sorted(list(set(iterate_images())), key=functools.cmp_to_key(compare_source_images))
+        return utils.toposort(dict.fromkeys(iterate_images()), getparents)
 
     def expose_ports(self, portrange):
         """Expose all ports on all ships."""
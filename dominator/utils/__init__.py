@@ -1,6 +1,5 @@
 import functools
 import itertools
-import inspect
 import string
 import logging
 import os.path
@@ -8,12 +7,22 @@ import glob
 import threading
 import contextlib
 import pprint
-import socket
+import hashlib
+import ctypes
+import shutil
+import collections
+import copyreg
+import pickle
 import collections.abc
+import concurrent.futures
+import weakref
+import queue
+import time
+import tempfile
+import io
+import sys
+import pkgutil
 
-import pkg_resources
-import yaml
-import docker
 import mergedict
 
 try:
@@ -24,7 +33,10 @@ except ImportError:
 
 # import PtyInterceptor to make it accessible from utils package
 from .pty import PtyInterceptor
-PtyInterceptor  # to avoid flake8 warning
+from .lazy import lazyimport, onload
+PtyInterceptor, onload  # to avoid flake8 warning
+
+yaml = lazyimport('yaml')
 
 
 def getlogger():
@@ -82,6 +94,176 @@ def setcontext(**kwargs):
         setattr(tl, k, v)
 
 
+_locks = weakref.WeakKeyDictionary()
+_lockslock = threading.Lock()
+
+
+def getlock(obj):
+    """Returns reentrant lock bound to the object."""
+    with _lockslock:
+        return _locks.setdefault(obj, threading.RLock())
+
+
+def inheritcontext(func):
+    """Wraps function to run it with a copy of the current thread-local
+    context. Used to pass callables to worker threads."""
+    context = getcontextdict().copy()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with addcontext(**context):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class DependencyError(Exception):
+    """Raised instead of calling function for object which dependency failed (see `parallel`)."""
+
+
+def toposort(objects, dependencies):
+    """Returns `objects` ordered so that each one goes after it's `dependencies(obj)`
+    (dependencies not in `objects` are ignored), otherwise original order is kept."""
+    objects = list(objects)
+    known = set(objects)
+    result, visited, visiting = [], set(), set()
+
+    def visit(obj):
+        if obj in visited:
+            return
+        if obj in visiting:
+            raise ValueError("dependency cycle found at {}".format(obj))
+        visiting.add(obj)
+        for dep in dependencies(obj):
+            if dep in known:
+                visit(dep)
+        visiting.discard(obj)
+        visited.add(obj)
+        result.append(obj)
+
+    for obj in objects:
+        visit(obj)
+    return result
+
+
+def parallel(func, objects, jobs=1, pergroup=0, groupkey=None, failfast=False, dependencies=None):
+    """Calls `func` for every object using at most `jobs` threads and
+    at most `pergroup` simultaneous calls for objects with the same
+    `groupkey(obj)` (0 means unlimited). Yields (object, future) pairs
+    in order of completion. With `failfast` no new calls are started
+    after the first failure. If `dependencies` is given, `func(obj)` is
+    called only after calls for all `dependencies(obj)` succeeded (if one
+    failed, DependencyError is set as result instead). If `jobs` is 1,
+    calls are made in the current thread one by one."""
+    if dependencies is not None:
+        objects = toposort(objects, dependencies)
+    known = set(objects) if dependencies is not None else set()
+    failed = set()
+
+    def depends(obj):
+        return [dep for dep in dependencies(obj) if dep in known] if known else []
+
+    def skip(obj):
+        future = concurrent.futures.Future()
+        future.set_exception(DependencyError("dependency of {} failed".format(obj)))
+        failed.add(obj)
+        return obj, future
+
+    if jobs <= 1:
+        for obj in objects:
+            if any(dep in failed for dep in depends(obj)):
+                yield skip(obj)
+                continue
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(func(obj))
+            except Exception as e:
+                future.set_exception(e)
+                failed.add(obj)
+            yield obj, future
+            if failfast and future.exception() is not None:
+                return
+        return
+
+    groupkey = groupkey or (lambda obj: None)
+    pending = collections.deque(objects)
+    running = {}
+    finished = set()
+    groups = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        while pending or running:
+            for obj in list(pending):
+                if len(running) >= jobs:
+                    break
+                deps = depends(obj)
+                if any(dep in failed for dep in deps):
+                    pending.remove(obj)
+                    yield skip(obj)
+                    continue
+                if not finished.issuperset(deps):
+                    continue
+                key = groupkey(obj)
+                if pergroup and key is not None and groups[key] >= pergroup:
+                    continue
+                pending.remove(obj)
+                groups[key] += 1
+                running[pool.submit(inheritcontext(func), obj)] = obj, key
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                obj, key = running.pop(future)
+                groups[key] -= 1
+                finished.add(obj)
+                if future.exception() is not None:
+                    failed.add(obj)
+                    if failfast:
+                        pending.clear()
+                yield obj, future
+
+
+def fanout(chunks, consumers, queuesize=16):
+    """Reads `chunks` iterable once and feeds it to all `consumers` simultaneously. Each consumer
+    is called in separate thread with iterable of chunks, at most `queuesize` chunks are
+    buffered for each one (so the slowest consumer limits the speed). Failed consumers are
+    skipped. Returns list of futures with consumer results in the same order.
+    If `chunks` raises, iterables of consumers raise too (so truncated stream is never taken
+    as complete one) and the exception is re-raised when all consumers are finished.
+    """
+    queues = [queue.Queue(queuesize) for _ in consumers]
+    failure = object()
+
+    def consume(consumer, chunkqueue):
+        def iterchunks():
+            for chunk in iter(chunkqueue.get, None):
+                if chunk is failure:
+                    raise RuntimeError('source of chunks failed')
+                yield chunk
+        return consumer(iterchunks())
+
+    with concurrent.futures.ThreadPoolExecutor(max(len(consumers), 1)) as pool:
+        futures = [pool.submit(inheritcontext(consume), consumer, chunkqueue)
+                   for consumer, chunkqueue in zip(consumers, queues)]
+
+        def put(future, chunkqueue, chunk):
+            while not future.done():
+                with contextlib.suppress(queue.Full):
+                    chunkqueue.put(chunk, timeout=1)
+                    return
+
+        last = failure
+        try:
+            for chunk in chunks:
+                if all(future.done() for future in futures):
+                    break
+                for future, chunkqueue in zip(futures, queues):
+                    put(future, chunkqueue, chunk)
+            last = None
+        finally:
+            for future, chunkqueue in zip(futures, queues):
+                put(future, chunkqueue, last)
+    return futures
+
+
 class ExtraInjector(logging.Filter):
     def __init__(self, blacklist=None):
         self.blacklist = blacklist or []
@@ -156,8 +338,108 @@ class PrettyDictInjector(logging.Filter):
         return True
 
 
-def cached(fun):
-    return functools.lru_cache(100)(fun)
+class Cache:
+    """Memoizes results of method `fun` separately for each instance (first argument), so
+    cached values live as long as the instance and could be invalidated per key. Results for
+    first arguments which can't be weakly referenced (like strings) are kept in shared storage.
+    If `ttl` is given, values expire after that number of seconds.
+    """
+    def __init__(self, fun, ttl=None):
+        functools.update_wrapper(self, fun)
+        self.fun = fun
+        self.ttl = ttl
+        self.instances = weakref.WeakKeyDictionary()
+        self.shared = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return BoundCache(self, instance)
+
+    def getstore(self, args, create=False):
+        """Returns (storage, key prefix) for given call arguments."""
+        try:
+            store = self.instances.setdefault(args[0], {}) if create else self.instances.get(args[0], {})
+            return store, args[1:]
+        except (TypeError, IndexError):
+            return self.shared, args
+
+    def __call__(self, *args, **kwargs):
+        now = time.monotonic()
+        with self.lock:
+            store, key = self.getstore(args, create=True)
+            key = key, tuple(sorted(kwargs.items()))
+            if key in store and (store[key][1] is None or store[key][1] > now):
+                self.hits += 1
+                return store[key][0]
+            self.misses += 1
+        value = self.fun(*args, **kwargs)
+        with self.lock:
+            store[key] = value, None if self.ttl is None else now + self.ttl
+        return value
+
+    def invalidate(self, *args, **kwargs):
+        """Drop value cached for given arguments (including instance)."""
+        with self.lock:
+            store, key = self.getstore(args)
+            store.pop((key, tuple(sorted(kwargs.items()))), None)
+
+    def clear(self, select=None):
+        """Drop all cached values or only values of instances for which `select(instance)` is true."""
+        with self.lock:
+            if select is None:
+                self.instances.clear()
+                self.shared.clear()
+            else:
+                for instance in [instance for instance in self.instances.keys() if select(instance)]:
+                    del self.instances[instance]
+
+    def cache_info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': sum(map(len, self.instances.values())) + len(self.shared)}
+
+    cache_clear = clear
+
+
+class BoundCache:
+    """Cached method bound to an instance (see `Cache`)."""
+    def __init__(self, cache, instance):
+        self.cache = cache
+        self.instance = instance
+
+    def __call__(self, *args, **kwargs):
+        return self.cache(self.instance, *args, **kwargs)
+
+    def invalidate(self, *args, **kwargs):
+        """Drop value cached for given arguments."""
+        self.cache.invalidate(self.instance, *args, **kwargs)
+
+    def clear(self):
+        """Drop all values cached for the instance."""
+        with self.cache.lock:
+            self.cache.instances.pop(self.instance, None)
+
+
+def cached(fun=None, ttl=None):
+    """Decorator memoizing function or method results (see `Cache`), could be used
+    as @cached or @cached(ttl=seconds).
+    """
+    if fun is None:
+        return functools.partial(Cache, ttl=ttl)
+    return Cache(fun, ttl)
+
+
+def freeze(value):
+    """Returns hashable snapshot of nested dicts/lists to cheaply detect their changes."""
+    if isinstance(value, collections.abc.Mapping):
+        return tuple((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return type(value).__name__, tuple(freeze(item) for item in value)
+    return value
 
 
 def groupbysorted(objects, key):
@@ -187,11 +469,61 @@ asdict = _as(dict)
 aslist = _as(list)
 
 
-@cached
 def getdocker(url=None):
-    url = url or settings.get('docker.url', default=None)
-    getlogger().debug('creating docker client', url=url)
-    return docker.Client(url)
+    """Returns Docker client for `url` (or for "docker.url" setting) which is
+    shared by all users of the same daemon."""
+    return _getdocker(url or settings.get('docker.url', default=None))
+
+
+@cached
+def _getdocker(url):
+    poolsize = settings.get('docker.pool.size', 10)
+    block = settings.get('docker.pool.block', True)
+    connect_timeout = settings.get('docker.timeout.connect', 10)
+    from . import dockerclient
+    getlogger().debug('creating docker client', url=url, poolsize=poolsize)
+    client = dockerclient.docker.Client(url, timeout=settings.get('docker.timeout.read', 60))
+    unixadapter = client.get_adapter(client.base_url)
+    if hasattr(unixadapter, 'socket_path'):
+        # replace docker-py's unix socket adapter with pooled one mounted to the same prefix
+        prefix = next(prefix for prefix, adapter in client.adapters.items() if adapter is unixadapter)
+        client.mount(prefix, dockerclient.UnixDockerAdapter(unixadapter.socket_path, poolsize, block, connect_timeout))
+    else:
+        client.mount('http://', dockerclient.DockerAdapter(poolsize, block, connect_timeout))
+    return client
+
+
+_imageindexes = weakref.WeakKeyDictionary()
+
+
+def getimageindex(dock):
+    """Returns {repository: {tag: id}} for all images of Docker daemon `dock`.
+    Images are listed by one call and shared until `invalidate_imageindex` is called.
+    """
+    with getlock(dock):
+        index = _imageindexes.get(dock)
+        if index is None:
+            getlogger().debug('listing images', docker=dock.base_url)
+            index = {}
+            for image in dock.images():
+                for repotag in image.get('RepoTags') or []:
+                    repository, _, tag = repotag.rpartition(':')
+                    index.setdefault(repository, {})[tag] = image['Id']
+            _imageindexes[dock] = index
+        return index
+
+
+@cached
+def inspectimage(imageid):
+    """Returns `inspect_image` result for image id from default Docker. Image ids are immutable,
+    so results are shared by all images and containers and never invalidated."""
+    return getdocker().inspect_image(imageid)
+
+
+def invalidate_imageindex(dock):
+    """Drop image index of `dock`, should be called after any change of it's images."""
+    with getlock(dock):
+        _imageindexes.pop(dock, None)
 
 
 @aslist
@@ -233,14 +565,15 @@ def compare_ports(cont, actual: dict):
 @aslist
 def compare_volumes(cont, cinfo):
     getlogger().debug('comparing volumes')
+    # volumes are compared one by one: containers are already checked in parallel workers
+    volumes = {volume.dest: volume for volume in cont.volumes.values()}
     for dest, path in cinfo['Volumes'].items():
         ro = not cinfo['VolumesRW'][dest]
-        matched_expected = [volume for volume in cont.volumes.values() if volume.dest == dest]
-        if len(matched_expected) == 0:
+        if dest not in volumes:
             if not path.startswith('/var/lib/docker/vfs/dir'):
                 yield ('volumes',), ('', dest)
         else:
-            volume = matched_expected[0]
+            volume = volumes[dest]
             with addcontext(volume=volume):
                 getlogger().debug('comparing volume')
 
@@ -253,8 +586,7 @@ def compare_volumes(cont, cinfo):
                     yield ('volumes', dest, 'ro'), (volume.ro, ro)
 
     for volume in cont.volumes.values():
-        matched_actual_path = [path for dest, path in cinfo['Volumes'].items() if dest == volume.dest]
-        if len(matched_actual_path) == 0:
+        if volume.dest not in cinfo['Volumes']:
             yield ('volumes',), (volume.dest, '')
 
 
@@ -304,63 +636,125 @@ def docker_lines(records):
             yield line
 
 
-def docker_attach(self, container, stdout=True, stderr=True,
-                  stdin=None, stream=False, logs=False):
-    if isinstance(container, dict):
-        container = container.get('Id')
-    params = {
-        'logs': logs and 1 or 0,
-        'stdin': stdin and 1 or 0,
-        'stdout': stdout and 1 or 0,
-        'stderr': stderr and 1 or 0,
-        'stream': stream and 1 or 0,
-    }
-    u = self._url("/containers/{0}/attach".format(container))
-    response = self._post(u, params=params, stream=stream)
-
-    sep = bytes()
-
-    if stdin:
-        sock = self._get_raw_response_socket(response)
-
-        def pump():
-            try:
-                for line in stdin:
-                    sock.sendall(line)
-                sock.shutdown(socket.SHUT_WR)
-            except:
-                getlogger().exception("error in stdin pump thread")
-
-        pumpthread = threading.Thread(target=pump)
-        pumpthread.daemon = True
-        pumpthread.start()
-
-    return stream and self._multiplexed_socket_stream_helper(response) or \
-        sep.join([x for x in self._multiplexed_buffer_helper(response)])
-docker.Client.attach = docker_attach
-
-
 def getcallingmodule(deep):
-    parent_frame = inspect.stack()[1+deep]
-    return inspect.getmodule(parent_frame[0])
-
-
-def resource_string(name):
-    return pkg_resources.resource_string(getcallingmodule(1).__name__, name).decode()
+    """Returns module `deep` frames up the stack from the caller. Only frame globals
+    are looked at, as inspect.stack() reads source files of all frames."""
+    return sys.modules[sys._getframe(1 + deep).f_globals['__name__']]
+
+
+def resource_string(name, package=None):
+    """Returns contents of package resource `name` (relative to package of calling module)."""
+    return pkgutil.get_data(package or getcallingmodule(1).__name__, name).decode()
+
+
+def resource_stream(name, package=None):
+    return io.BytesIO(pkgutil.get_data(package or getcallingmodule(1).__name__, name))
+
+
+def getmanifest(path):
+    """Returns {relative path: sha1} for all files inside the directory."""
+    manifest = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            with open(filepath, 'rb') as file:
+                manifest[os.path.relpath(filepath, path)] = hashlib.sha1(file.read()).hexdigest()
+    return manifest
+
+
+def manifestpath(path):
+    """Returns path of the directory manifest. It is placed near the directory, not inside, to not be
+    visible in container."""
+    path = path.rstrip('/')
+    return os.path.join(os.path.dirname(path), '.{}.manifest'.format(os.path.basename(path)))
+
+
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def replacedir(src, dst, keepold=False):
+    """Replace `dst` directory with `src` directory and remove the old one (or move it to
+    `dst + '.old'` if `keepold` is set, as it could be still bind-mounted into running container).
+    Directories are swapped atomically using renameat2(RENAME_EXCHANGE) if it is supported,
+    otherwise using two renames.
+    """
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+    old = dst + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 is not None and renameat2(AT_FDCWD, src.encode(), AT_FDCWD, dst.encode(), RENAME_EXCHANGE) == 0:
+        if keepold:
+            os.rename(src, old)
+        else:
+            shutil.rmtree(src)
+        return
+    getlogger().debug("atomic directory exchange is not supported, using two renames", errno=ctypes.get_errno())
+    os.rename(dst, old)
+    os.rename(src, dst)
+    if not keepold:
+        shutil.rmtree(old)
+
+
+def evictfiles(dirpath, maxsize, keep=None):
+    """Remove least recently modified files from `dirpath` until their total size is at most
+    `maxsize` bytes. Hidden (temporary) files and `keep` file are not removed."""
+    files = []
+    for name in os.listdir(dirpath):
+        path = os.path.join(dirpath, name)
+        with contextlib.suppress(OSError):
+            if not name.startswith('.') and path != keep:
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files) + (os.path.getsize(keep) if keep is not None else 0)
+    for _, size, path in sorted(files):
+        if total <= maxsize:
+            break
+        getlogger().debug("evicting cached file", path=path, size=size)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        total -= size
+
+
+def replacefile(path, data):
+    """Write `data` to temporary file and atomically rename it to `path`, so `path` always
+    has either old or new contents. Permissions of the replaced file are kept.
+    """
+    path = os.path.abspath(path)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', delete=False) as file:
+        try:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+            if os.path.exists(path):
+                shutil.copymode(path, file.name)
+            else:
+                os.chmod(file.name, 0o666 & ~getumask())
+        except BaseException:
+            os.unlink(file.name)
+            raise
+    os.replace(file.name, path)
 
 
-def resource_stream(name):
-    return pkg_resources.resource_stream(getcallingmodule(1).__name__, name)
+def getumask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
 
 
 def stoppable(cmd):
     return 'trap exit TERM; {} & wait'.format(cmd)
 
 
+@functools.lru_cache(None)
 def getversion():
+    import importlib.metadata
     try:
-        return pkg_resources.get_distribution('dominator').version
-    except pkg_resources.DistributionNotFound:
+        return importlib.metadata.version('dominator')
+    except importlib.metadata.PackageNotFoundError:
         return '(local)'
 
 
@@ -399,6 +793,31 @@ class BackrefDict(collections.abc.MutableMapping):
         del self.children[key]
 
 
+class LazyBackrefDict(BackrefDict):
+    """BackrefDict which items are loaded by `loader(key)` on first access (see `snapshot`).
+    When pickled it's saved as ordinary BackrefDict with all items."""
+    lock = threading.RLock()
+
+    def __init__(self, parent, loader, key):
+        self.parent = parent
+        self._loader = loader
+        self._key = key
+
+    @property
+    def children(self):
+        with self.lock:
+            if '_children' not in vars(self):
+                self._children = self._loader(self._key)
+            return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+
+    def __reduce_ex__(self, protocol):
+        return copyreg._reconstructor, (BackrefDict, object, None), {'parent': self.parent, 'children': self.children}
+
+
 NONEXISTENT_KEY = object()
 
 
@@ -407,54 +826,92 @@ class NoSuchSetting(Exception):
 
 
 class Settings:
+    """Settings merged from yaml files in /etc/dominator and `dirpath`. Parsed files are
+    cached in `cachepath` until any of them is changed. Merged settings are compiled into
+    flat {dotted path: value} map (sections included), so lookup is a single dict access.
+    """
     def __init__(self):
         self._dict = mergedict.ConfigDict()
         self.dirpath = os.path.expanduser('~/.config/dominator')
+        self.cachepath = os.path.expanduser('~/.cache/dominator/settings.pickle')
+        self.compile()
+
+    def readfiles(self):
+        """Returns [(filename, data)] for all settings files."""
+        stamps = []
+        for filename in itertools.chain(
+            glob.glob('/etc/dominator/*.yaml'),
+            glob.glob(os.path.join(self.dirpath, '*.yaml')),
+        ):
+            with contextlib.suppress(OSError):
+                stat = os.stat(filename)
+                stamps.append((filename, stat.st_mtime_ns, stat.st_size))
+        try:
+            with open(self.cachepath, 'rb') as file:
+                cachedstamps, files = pickle.load(file)
+            if cachedstamps == stamps:
+                getlogger().debug("loading settings from cache", path=self.cachepath)
+                return files
+        except Exception as e:
+            getlogger().debug("settings cache is not used", path=self.cachepath, error=repr(e))
+
+        files = []
+        for filename, _, _ in stamps:
+            getlogger().info("loading settings from %s", filename)
+            with open(filename) as file:
+                files.append((filename, yaml.load(file)))
+        try:
+            os.makedirs(os.path.dirname(self.cachepath), exist_ok=True)
+            replacefile(self.cachepath, pickle.dumps((stamps, files), pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            getlogger().warning("could not save settings cache", path=self.cachepath, exc_info=True)
+        return files
 
     def load(self, file):
         if file is None:
-            for filename in itertools.chain(
-                glob.glob('/etc/dominator/*.yaml'),
-                glob.glob(os.path.join(self.dirpath, '*.yaml')),
-            ):
-                getlogger().debug("checking existense of %s", filename)
-                if os.path.exists(filename):
-                    getlogger().info("loading settings from %s", filename)
-                    data = yaml.load(open(filename))
-                    if isinstance(data, dict):
-                        self._dict.merge(data)
-                    else:
-                        getlogger().warning("wrong format of %s", filename)
+            for filename, data in self.readfiles():
+                if isinstance(data, dict):
+                    self._dict.merge(data)
+                else:
+                    getlogger().warning("wrong format of %s", filename)
         else:
             data = yaml.load(file)
             self._dict.merge(data)
+        self.compile()
+
+    def compile(self):
+        """Rebuild flat map of settings, should be called after any change of `_dict`."""
+        flat = {}
+        stack = [('', self._dict)]
+        while stack:
+            path, value = stack.pop()
+            flat[path] = value
+            if isinstance(value, dict):
+                stack.extend(('{}.{}'.format(path, key) if path else key, item) for key, item in value.items()
+                             if isinstance(key, str) and key and '.' not in key)
+        self._flat = flat
 
     def get(self, path, default=NONEXISTENT_KEY, type_=None, help=None):
-        with addcontext(key=path):
-            logger = getlogger()
-            if type_ is None and default is not NONEXISTENT_KEY and default is not None:
-                type_ = type(default)
-            parts = path.split('.')
+        value = self._flat.get(path, NONEXISTENT_KEY)
+        if value is NONEXISTENT_KEY and (path.startswith('.') or path.endswith('.') or '..' in path):
+            # empty parts are ignored, e.g. ".docker" is the same as "docker"
+            value = self._flat.get('.'.join(part for part in path.split('.') if part), NONEXISTENT_KEY)
+        if value is NONEXISTENT_KEY:
+            if default is NONEXISTENT_KEY:
+                getlogger().error("key is not found in config and no default value provided", key=path)
+                raise NoSuchSetting(path)
+            getlogger().debug("key is not found in config, using default value", key=path, default=default)
+            return default
+        if type_ is None and default is not NONEXISTENT_KEY and default is not None:
+            type_ = type(default)
+        if type_ is not None:
             try:
-                value = self._dict
-                for part in parts:
-                    if part == '':
-                        continue
-                    value = value[part]
-                if type_ is not None:
-                    try:
-                        value = type_(value)
-                    except:
-                        logger.warning("could not convert config value to required type", value=value, type=type_)
-                        raise
-                return value
-            except KeyError as exc:
-                if default is NONEXISTENT_KEY:
-                    logger.error("key is not found in config and no default value provided")
-                    raise NoSuchSetting(path) from exc
-                else:
-                    logger.debug("key is not found in config, using default value", default=default)
-                    return default
+                value = type_(value)
+            except:
+                getlogger().warning("could not convert config value to required type",
+                                    key=path, value=value, type=type_)
+                raise
+        return value
 
     def __getitem__(self, path):
         return self.get(path)
@@ -468,6 +925,7 @@ class Settings:
                 section[part] = {}
             section = section[part]
         section[parts[-1]] = value
+        self.compile()
 
     def __setitem__(self, path, value):
         return self.set(path, value)
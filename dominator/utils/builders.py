@@ -0,0 +1,69 @@
+"""
+Pool of Docker daemons used to build source images simultaneously (see "build.builders" setting).
+"""
+
+import collections
+import threading
+
+from . import getdocker, getlogger
+
+
+class BuilderPool:
+    """Chooses Docker daemon to build each image on: builders already having the parent image
+    are preferred, then the least loaded one. Parent images missing on chosen builder are
+    transferred from the builder they were built on or pulled.
+    """
+    def __init__(self, urls):
+        self.builders = [getdocker(url) for url in urls]
+        self.lock = threading.Lock()
+        self.load = collections.Counter()
+        self.locations = {}
+
+    def locate(self, image):
+        """Returns builder having the image or None."""
+        with self.lock:
+            if image in self.locations:
+                return self.locations[image]
+        for dock in self.builders:
+            if image.getid(dock) is not None:
+                with self.lock:
+                    self.locations.setdefault(image, dock)
+                return dock
+        return None
+
+    def acquire(self, image):
+        """Choose builder for the image and mark it busy."""
+        parent = getattr(image, 'parent', None)
+        candidates = [dock for dock in self.builders if parent is not None and parent.getid(dock) is not None]
+        with self.lock:
+            dock = min(candidates or self.builders, key=lambda dock: self.load[dock])
+            self.load[dock] += 1
+        return dock
+
+    def release(self, dock):
+        with self.lock:
+            self.load[dock] -= 1
+
+    def prepare(self, image, dock):
+        """Make parent of the image available on builder `dock`."""
+        parent = getattr(image, 'parent', None)
+        if parent is None or parent.getid(dock) is not None:
+            return
+        source = self.locate(parent)
+        if source is not None:
+            parent.transfer([dock], source)
+        else:
+            parent.pull(dock, tag=parent.tag)
+
+    def build(self, image, **kwargs):
+        """Build the image on chosen builder, returns the builder."""
+        dock = self.acquire(image)
+        getlogger().info('building on builder', builder=dock.base_url)
+        try:
+            self.prepare(image, dock)
+            image.build(dock, parents=False, **kwargs)
+        finally:
+            self.release(dock)
+        with self.lock:
+            self.locations[image] = dock
+        return dock
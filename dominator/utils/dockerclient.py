@@ -0,0 +1,102 @@
+"""
+Docker client tweaks: pooled HTTP adapters and stdin support in `attach`. The module is imported
+by `getdocker` on first use to not import docker-py and requests on startup.
+"""
+
+import socket
+import threading
+
+import docker
+import requests.adapters
+import urllib3
+
+from . import getlogger
+
+
+class UnixHTTPConnection(urllib3.connection.HTTPConnection):
+    def __init__(self, *args, socket_path, **kwargs):
+        self.socket_path = socket_path
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+
+class DockerAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter keeping up to `poolsize` keep-alive connections to Docker daemon.
+    If `block` is set, requests wait for a free connection instead of opening a new one.
+    """
+    def __init__(self, poolsize, block, connect_timeout):
+        self.connect_timeout = connect_timeout
+        super().__init__(pool_connections=1, pool_maxsize=poolsize, pool_block=block)
+
+    def send(self, request, timeout=None, **kwargs):
+        if not isinstance(timeout, tuple):
+            timeout = (self.connect_timeout, timeout)
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class UnixDockerAdapter(DockerAdapter):
+    """Same as DockerAdapter, but connects to Docker daemon via unix socket."""
+    def __init__(self, socket_path, poolsize, block, connect_timeout):
+        super().__init__(poolsize, block, connect_timeout)
+        self.socket_path = socket_path
+        self.pool = UnixHTTPConnectionPool('localhost', maxsize=poolsize, block=block, socket_path=socket_path)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        self.pool.close()
+        super().close()
+
+
+def docker_attach(self, container, stdout=True, stderr=True,
+                  stdin=None, stream=False, logs=False):
+    if isinstance(container, dict):
+        container = container.get('Id')
+    params = {
+        'logs': logs and 1 or 0,
+        'stdin': stdin and 1 or 0,
+        'stdout': stdout and 1 or 0,
+        'stderr': stderr and 1 or 0,
+        'stream': stream and 1 or 0,
+    }
+    u = self._url("/containers/{0}/attach".format(container))
+    response = self._post(u, params=params, stream=stream)
+
+    sep = bytes()
+
+    if stdin:
+        sock = self._get_raw_response_socket(response)
+
+        def pump():
+            try:
+                for line in stdin:
+                    sock.sendall(line)
+                sock.shutdown(socket.SHUT_WR)
+            except Exception:
+                getlogger().exception("error in stdin pump thread")
+
+        pumpthread = threading.Thread(target=pump)
+        pumpthread.daemon = True
+        pumpthread.start()
+
+    return stream and self._multiplexed_socket_stream_helper(response) or \
+        sep.join([x for x in self._multiplexed_buffer_helper(response)])
+
+
+docker.Client.attach = docker_attach
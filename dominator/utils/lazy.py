@@ -0,0 +1,68 @@
+"""
+Lazy imports of heavy third-party modules (docker, yaml and so on) to keep CLI startup fast:
+module is imported on first attribute access of it's proxy returned by `lazyimport`.
+"""
+
+import importlib
+import threading
+
+_lock = threading.RLock()
+_modules = {}
+
+
+class LazyModule:
+    """Proxy of module `name`. Submodules which are not imported by the package itself
+    are imported on access too (e.g. `lazyimport('mako').template`)."""
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+        object.__setattr__(self, '_hooks', [])
+
+    def _load(self):
+        with _lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                for hook in self._hooks:
+                    hook(module)
+                object.__setattr__(self, '_module', module)
+            return self._module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            try:
+                return importlib.import_module('{}.{}'.format(self._name, attr))
+            except ImportError:
+                raise AttributeError("module '{}' has no attribute '{}'".format(self._name, attr)) from None
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {!r} ({})>'.format(self._name, state)
+
+
+def lazyimport(name):
+    """Returns proxy of module `name` shared by all callers."""
+    with _lock:
+        return _modules.setdefault(name, LazyModule(name))
+
+
+def onload(name, hook):
+    """Call `hook(module)` when module `name` is loaded through it's proxy (or right now if it's
+    already loaded). Used for global setup of third-party modules, like yaml representers."""
+    module = lazyimport(name)
+    with _lock:
+        if module._module is None:
+            module._hooks.append(hook)
+        else:
+            hook(module._module)
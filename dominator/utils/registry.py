@@ -0,0 +1,136 @@
+"""
+Docker registry HTTP API client used to check which image tags are already pushed
+(registry API v2 with fallback to v1). Bearer and Basic authentication are supported,
+credentials are taken from Docker client config (~/.docker/config.json or ~/.dockercfg).
+"""
+
+import base64
+import functools
+import json
+import os
+import re
+import threading
+
+import requests
+
+from . import getlogger, parallel, settings
+
+DEFAULT_REGISTRY = 'registry-1.docker.io'
+# keys Docker client uses for Docker Hub credentials
+DEFAULT_INDEXES = ['https://index.docker.io/v1/', 'index.docker.io', 'docker.io']
+DOCKER_CONFIGS = [('~/.docker/config.json', 'auths'), ('~/.dockercfg', None)]
+MANIFEST_TYPES = ', '.join([
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v1+prettyjws',
+])
+
+_local = threading.local()
+
+
+class RegistryError(Exception):
+    pass
+
+
+def getsession():
+    """Returns requests session for the current thread."""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def geturl(registry):
+    scheme = 'http' if settings.get('docker.registry.insecure', False) else 'https'
+    return '{}://{}'.format(scheme, registry or DEFAULT_REGISTRY)
+
+
+def getname(namespace, repository, registry=None):
+    """Returns repository name as used in API requests."""
+    if namespace is None and registry is None:
+        namespace = 'library'
+    return '{}/{}'.format(namespace, repository) if namespace else repository
+
+
+@functools.lru_cache(None)
+def getcredentials(registry):
+    """Returns (username, password) for the registry from Docker client config or None."""
+    keys = DEFAULT_INDEXES if registry is None else [registry, 'https://' + registry, 'http://' + registry]
+    for path, section in DOCKER_CONFIGS:
+        try:
+            with open(os.path.expanduser(path)) as file:
+                config = json.load(file)
+        except (OSError, ValueError):
+            continue
+        auths = config.get(section, {}) if section else config
+        for key in keys:
+            for variant in key, key.rstrip('/'), key + '/v1/':
+                if auths.get(variant, {}).get('auth'):
+                    username, _, password = base64.b64decode(auths[variant]['auth']).decode().partition(':')
+                    return username, password
+    return None
+
+
+def gettoken(response, credentials=None):
+    """Get bearer token according to Www-Authenticate header of 401 response."""
+    challenge = response.headers.get('Www-Authenticate', '')
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop('realm')
+    reply = getsession().get(realm, params=params, auth=credentials, timeout=settings.get('docker.timeout.read', 60))
+    reply.raise_for_status()
+    return reply.json().get('token') or reply.json()['access_token']
+
+
+def request(method, url, registry=None, **kwargs):
+    """Make request retrying it with credentials or bearer token if registry requires them."""
+    kwargs.setdefault('timeout', (settings.get('docker.timeout.connect', 10), settings.get('docker.timeout.read', 60)))
+    response = getsession().request(method, url, **kwargs)
+    if response.status_code == 401:
+        challenge = response.headers.get('Www-Authenticate', '')
+        credentials = getcredentials(registry)
+        if challenge.startswith('Bearer '):
+            headers = dict(kwargs.pop('headers', {}), Authorization='Bearer ' + gettoken(response, credentials))
+            response = getsession().request(method, url, headers=headers, **kwargs)
+        elif challenge.startswith('Basic ') and credentials is not None:
+            response = getsession().request(method, url, auth=credentials, **kwargs)
+        elif challenge.startswith('Basic '):
+            raise RegistryError('registry requires credentials, but there are none in Docker config')
+        else:
+            raise RegistryError('unsupported registry authentication: {}'.format(challenge))
+    return response
+
+
+@functools.lru_cache(None)
+def getversion(registry):
+    """Returns API version supported by the registry: 2 or 1."""
+    response = getsession().get(geturl(registry) + '/v2/', timeout=(
+        settings.get('docker.timeout.connect', 10), settings.get('docker.timeout.read', 60)))
+    return 2 if response.status_code in (200, 401) else 1
+
+
+def hastag(registry, name, tag):
+    """Returns True if the registry has the tag in repository `name` (see `getname`)."""
+    if getversion(registry) == 2:
+        response = request('HEAD', '{}/v2/{}/manifests/{}'.format(geturl(registry), name, tag),
+                           registry, headers={'Accept': MANIFEST_TYPES})
+    else:
+        response = request('GET', '{}/v1/repositories/{}/tags/{}'.format(geturl(registry), name, tag), registry)
+    if response.status_code == 404:
+        return False
+    if response.status_code == 200:
+        return True
+    raise RegistryError('unexpected registry response for {}:{} ({} {})'.format(
+        name, tag, response.status_code, response.reason))
+
+
+def hastags(refs, jobs=8):
+    """Check many (registry, name, tag) refs simultaneously. Returns {ref: True/False/None},
+    None means the ref could not be checked (e.g. registry is unreachable or refuses access).
+    """
+    refs = sorted(set(refs), key=lambda ref: tuple(item or '' for item in ref))
+    getlogger().debug('checking tags in registry', count=len(refs))
+    result = {}
+    for ref, future in parallel(lambda ref: hastag(*ref), refs, jobs):
+        if future.exception() is not None:
+            getlogger().warning('could not check tag in registry: {}'.format(future.exception()), ref=ref)
+        result[ref] = None if future.exception() is not None else future.result()
+    return result
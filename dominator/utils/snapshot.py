@@ -0,0 +1,274 @@
+"""
+Compact versioned shipment snapshots.
+
+Snapshot is a magic header with format version followed by pickle of the shipment
+in which all equal strings and tuples are replaced with one shared object, so
+they are stored (and loaded) only once. Equal dicts and lists are not merged as
+they could be changed independently after loading. Garbage collector is paused
+during loading because it spends most of the time scanning just created objects.
+
+Since version 2 snapshot is indexed: items of volume "files" dicts (file contents,
+templates and so on) are stored as separate blobs after the shipment skeleton and
+are loaded only when accessed (see `LazyBackrefDict`). References from blobs to
+skeleton objects (like volume, container or ship) are stored as indexes in the
+table of such objects saved with the skeleton. Long strings used more than once
+(e.g. the same file contents in many containers) are stored in that table too.
+
+Only volume files are lazy: ships, containers, images and volumes are always loaded
+as a whole, because command filters match objects by their names and references
+between them. So loading time still grows with the number of containers, but
+it doesn't depend on the size of their config files.
+
+Layout of version 2: header, skeleton length, skeleton pickle of (shipment,
+referenced objects, lazy dicts, blob index), token, blobs. Token is a digest of
+skeleton and blobs, it's used to check that file was not changed since it was
+loaded and makes snapshots of equal shipments equal.
+"""
+
+import collections
+import contextlib
+import gc
+import hashlib
+import io
+import pickle
+import struct
+import threading
+import weakref
+
+from . import BackrefDict, LazyBackrefDict
+
+MAGIC = b'\x89DOMSNAP'
+VERSION = 2
+HEADER = struct.Struct('>{}sH'.format(len(MAGIC)))
+LENGTH = struct.Struct('>Q')
+TOKENSIZE = 16
+# file name extension used to choose snapshot format when saving shipment
+EXTENSION = '.snapshot'
+# strings at least that long used more than once are shared between blobs
+SHARED_LENGTH = 32
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def nogc():
+    """Pause garbage collector (if it's enabled)."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def isobject(obj):
+    """Check if `obj` is an instance with attributes (not a class or function)."""
+    return hasattr(obj, '__dict__') and not isinstance(obj, type) and not callable(obj)
+
+
+class Canonizer:
+    """Replaces equal strings and tuples in object graph with the same objects."""
+    def __init__(self):
+        self.strings = {}
+        self.counts = collections.Counter()
+        self.tuples = {}
+        self.seen = set()
+
+    def __call__(self, obj):
+        objtype = type(obj)
+        if objtype is str:
+            self.counts[obj] += 1
+            return self.strings.setdefault(obj, obj)
+        if objtype in (int, float, bool, bytes, type(None)) or id(obj) in self.seen:
+            return obj
+        self.seen.add(id(obj))
+        if objtype is tuple:
+            obj = tuple(map(self, obj))
+            with contextlib.suppress(TypeError):
+                obj = self.tuples.setdefault(obj, obj)
+        elif objtype is list:
+            obj[:] = map(self, obj)
+        elif objtype is dict:
+            items = [(self(key), self(value)) for key, value in obj.items()]
+            obj.clear()
+            obj.update(items)
+        elif isobject(obj):
+            self(vars(obj))
+        return obj
+
+
+def islazy(obj):
+    """Returns True for BackrefDicts stored as separate blobs (volume files)."""
+    return type(obj) is BackrefDict and getattr(obj.parent, 'files', None) is obj
+
+
+def walk(root, skip):
+    """Returns {id: object} for all instances reachable from `root` not going inside `skip` objects."""
+    found, seen, stack = {}, set(), [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or type(obj) in (str, int, float, bool, bytes, type(None)):
+            continue
+        seen.add(id(obj))
+        if type(obj) in (list, tuple, set, frozenset):
+            stack.extend(obj)
+        elif type(obj) is dict:
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isobject(obj):
+            found[id(obj)] = obj
+            if id(obj) in skip:
+                stack.append(obj.parent)
+            else:
+                stack.append(vars(obj))
+    return found
+
+
+class BlobPickler(pickle.Pickler):
+    """Pickler storing references to skeleton objects (and shared strings) as indexes in `refs` list."""
+    def __init__(self, file, skeleton, refs, indexes):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.skeleton = skeleton
+        self.refs = refs
+        self.indexes = indexes
+
+    def persistent_id(self, obj):
+        if id(obj) not in self.skeleton:
+            return None
+        if id(obj) not in self.indexes:
+            self.indexes[id(obj)] = len(self.refs)
+            self.refs.append(obj)
+        return self.indexes[id(obj)]
+
+
+class SkeletonPickler(pickle.Pickler):
+    """Pickler saving lazy dicts without their items."""
+    def reducer_override(self, obj):
+        if type(obj) is LazyBackrefDict:
+            return LazyBackrefDict.__new__, (LazyBackrefDict,), {'parent': obj.parent, '_key': obj._key}
+        return NotImplemented
+
+
+def dumps(obj):
+    """Returns snapshot of `obj`. `obj` itself is not changed, it's pickled copy is canonized
+    and split into skeleton and blobs.
+    """
+    with nogc():
+        copy = pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    canonizer = Canonizer()
+    copy = canonizer(copy)
+    lazydicts = [item for item in walk(copy, set()).values() if islazy(item)]
+    skeleton = walk(copy, {id(item) for item in lazydicts})
+    shared = [canonizer.strings[string] for string, count in canonizer.counts.items()
+              if count > 1 and len(string) >= SHARED_LENGTH]
+    skeleton.update((id(string), string) for string in shared)
+    refs, indexes, blobs, index, children = [], {}, io.BytesIO(), [], []
+    for key, lazydict in enumerate(lazydicts):
+        start = blobs.tell()
+        BlobPickler(blobs, skeleton, refs, indexes).dump(lazydict.children)
+        index.append((start, blobs.tell() - start))
+        # the dict is used in place to keep all references to it, items stay available
+        # in memory for __getstate__ methods called while pickling skeleton
+        children.append(vars(lazydict).pop('children'))
+        lazydict.__class__ = LazyBackrefDict
+        lazydict._loader = children.__getitem__
+        lazydict._key = key
+    data = io.BytesIO()
+    SkeletonPickler(data, pickle.HIGHEST_PROTOCOL).dump((copy, refs, lazydicts, index))
+    skeletondata, blobdata = data.getvalue(), blobs.getvalue()
+    token = hashlib.sha1(skeletondata + blobdata).digest()[:TOKENSIZE]
+    return b''.join([HEADER.pack(MAGIC, VERSION), LENGTH.pack(len(skeletondata)), skeletondata,
+                     token, blobdata])
+
+
+def issnapshot(data):
+    """Check if `data` (or it's beginning) is a snapshot."""
+    return data[:len(MAGIC)] == MAGIC
+
+
+class Reader:
+    """Loads snapshot skeleton and then blobs on demand using `read(offset, length)` function.
+    `close` is called as soon as all blobs are loaded or the reader is garbage collected."""
+    def __init__(self, read, close=None):
+        self.read = read
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.close = weakref.finalize(self, close or (lambda: None))
+
+    def load(self):
+        try:
+            root = self._load()
+        finally:
+            if not self.pending:
+                self.close()
+        return root
+
+    def _load(self):
+        magic, version = HEADER.unpack(self.read(0, HEADER.size))
+        if magic != MAGIC:
+            raise SnapshotError("not a snapshot")
+        if version > VERSION:
+            raise SnapshotError("snapshot format version {} is not supported (up to {})".format(version, VERSION))
+        if version == 1:
+            with nogc():
+                return pickle.loads(self.read(HEADER.size, None))
+        length, = LENGTH.unpack(self.read(HEADER.size, LENGTH.size))
+        with nogc():
+            root, self.refs, lazydicts, self.index = pickle.loads(self.read(HEADER.size + LENGTH.size, length))
+        self.blobs = HEADER.size + LENGTH.size + length
+        self.token = self.read(self.blobs, TOKENSIZE)
+        for lazydict in lazydicts:
+            lazydict._loader = self.loadblob
+        self.pending = set(range(len(self.index)))
+        return root
+
+    def loadblob(self, key):
+        """Load items of lazy dict number `key`."""
+        offset, length = self.index[key]
+        with self.lock:
+            if self.read(self.blobs, TOKENSIZE) != self.token:
+                raise SnapshotError("snapshot was changed since it was loaded")
+            data = self.read(self.blobs + TOKENSIZE + offset, length)
+            self.pending.discard(key)
+            if not self.pending:
+                self.close()
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = self.refs.__getitem__
+        return unpickler.load()
+
+
+def loads(data):
+    """Load object from snapshot."""
+    if not issnapshot(data):
+        raise SnapshotError("not a snapshot")
+    data = memoryview(data)
+    return Reader(lambda offset, length: data[offset:None if length is None else offset + length]).load()
+
+
+def load(file):
+    """Load object from binary file containing either snapshot or plain pickle."""
+    data = file.read()
+    if issnapshot(data):
+        return loads(data)
+    return pickle.loads(data)
+
+
+def loadpath(path):
+    """Load object from file containing either snapshot or plain pickle. Only skeleton of
+    snapshot is read, other data is read from the file when accessed.
+    """
+    with open(path, 'rb') as file:
+        if not issnapshot(file.read(len(MAGIC))):
+            file.seek(0)
+            return pickle.load(file)
+
+    file = open(path, 'rb', buffering=0)
+
+    def read(offset, length):
+        # called under Reader.lock
+        file.seek(offset)
+        return file.read(-1 if length is None else length)
+    return Reader(read, file.close).load()
@@ -0,0 +1,242 @@
+"""
+SSH connections multiplexed over one persistent master connection per host
+(see ControlMaster and ControlPersist in ssh_config(5)).
+"""
+
+import atexit
+import contextlib
+import functools
+import gzip
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import openssh_wrapper
+from openssh_wrapper import SSHError, SSHResult, b, b_list, b_quote
+
+# size of chunks streamed through pipes, only this much of transferred data is kept in memory
+CHUNKSIZE = 1 << 16
+
+# compression method: (command compressing stdin to stdout with level, tar option to decompress)
+COMPRESSORS = {
+    'none': (None, []),
+    'gzip': ('gzip -c -{level}', ['--gzip']),
+    'zstd': ('zstd -q -c -{level}', ['--use-compress-program=zstd']),
+}
+DEFAULT_LEVELS = {'none': 0, 'gzip': 6, 'zstd': 3}
+# compression method: command decompressing stdin to stdout
+DECOMPRESSORS = {'none': None, 'gzip': 'gzip -dc', 'zstd': 'zstd -dc'}
+# shell function atomically swapping two directories (or moving the first one if the second one
+# does not exist) with "mv --exchange" (coreutils >= 9.5) or renameat2(RENAME_EXCHANGE) via python3,
+# it fails leaving both directories intact if neither is supported
+EXCHANGE = (
+    'exchange() { if [ ! -e "$2" ]; then mv -T -- "$1" "$2"; '
+    'elif mv --exchange -T -- "$1" "$2" 2>/dev/null; then :; '
+    'else python3 -c \'import ctypes, sys; libc = ctypes.CDLL(None, use_errno=True); '
+    'sys.exit(libc.renameat2(-100, sys.argv[1].encode(), -100, sys.argv[2].encode(), 2) and '
+    '"renameat2: " + __import__("os").strerror(ctypes.get_errno()))\' "$1" "$2"; fi; }'
+)
+
+
+@functools.lru_cache(1)
+def getcontroldir():
+    """Returns directory for control sockets which is removed on exit."""
+    controldir = tempfile.mkdtemp(prefix='dominator-ssh-')
+    atexit.register(shutil.rmtree, controldir, ignore_errors=True)
+    return controldir
+
+
+class SSHConnection(openssh_wrapper.SSHConnection):
+    """SSHConnection that runs all ssh/scp commands through a shared master connection.
+    Unlike original SSHConnection it uses subprocess timeouts instead of SIGALRM, so it
+    could be used from several threads simultaneously.
+    """
+    def __init__(self, server, login=None, persist=60, **kwargs):
+        super().__init__(server, login=login, **kwargs)
+        self.persist = persist
+        self.master = False
+        self.lock = threading.Lock()
+        # unix socket path length is limited, so use hash instead of login@host:port
+        key = '{}@{}:{}'.format(login, server, self.port).encode()
+        self.controlpath = os.path.join(getcontroldir(), hashlib.sha1(key).hexdigest()[:16])
+
+    def options(self):
+        return b_list(['-o', 'ControlMaster=auto', '-o', 'ControlPath={}'.format(self.controlpath),
+                       '-o', 'ControlPersist={}'.format(self.persist)])
+
+    def ssh_command(self, interpreter, forward_ssh_agent):
+        command = super().ssh_command(interpreter, forward_ssh_agent)
+        return command[:1] + self.options() + command[1:]
+
+    def scp_command(self, files, target):
+        command = super().scp_command(files, target)
+        return command[:1] + self.options() + command[1:]
+
+    def connect(self):
+        """Start master connection if it is not started yet."""
+        with self.lock:
+            if not self.master:
+                returncode, _, err = self._communicate(self.ssh_command('true', False), None)
+                if returncode != 0:
+                    raise SSHError(err.strip())
+                self.master = True
+                atexit.register(self.close)
+
+    def close(self):
+        """Stop master connection."""
+        with self.lock:
+            if self.master:
+                command = self.ssh_command('', False)[:-1]
+                command[1:1] = [b'-O', b'exit']
+                subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=self.get_env())
+                self.master = False
+
+    def _communicate(self, command, input):
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=self.get_env())
+        try:
+            out, err = process.communicate(input, timeout=self.timeout)
+        except subprocess.TimeoutExpired as exc:
+            process.kill()
+            process.communicate()
+            raise SSHError(str(exc))
+        return process.returncode, out, err
+
+    def run(self, command, interpreter='/bin/bash', forward_ssh_agent=False):
+        self.connect()
+        returncode, out, err = self._communicate(self.ssh_command(interpreter, forward_ssh_agent), b(command))
+        if returncode == 255:  # ssh client error
+            raise SSHError(err.strip())
+        return SSHResult(command, out.strip(), err.strip(), returncode)
+
+    def bash_command(self, command):
+        """Returns ssh command running shell `command` with bash like `run` does, as login shell
+        of the server could be plain sh (which doesn't support e.g. "set -o pipefail")."""
+        return self.ssh_command('/bin/bash -c ' + shlex.quote(command), False)
+
+    def pipe(self, command, input=None):
+        """Run `command` on server passing `input` to it's stdin. Output is not stripped."""
+        self.connect()
+        returncode, out, err = self._communicate(self.bash_command(command), input)
+        if returncode == 255:  # ssh client error
+            raise SSHError(err.strip())
+        return SSHResult(command, out, err, returncode)
+
+    def popen(self, command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL):
+        """Start `command` on server and return subprocess.Popen object for streaming to/from it.
+        Stderr is collected to temporary file (see `check`).
+        """
+        self.connect()
+        errors = tempfile.TemporaryFile()
+        process = subprocess.Popen(self.bash_command(command), stdin=stdin, stdout=stdout,
+                                   stderr=errors, env=self.get_env())
+        process.errors = errors
+        return process
+
+    @staticmethod
+    def check(process):
+        """Wait for process started by `popen` and raise SSHError if it failed."""
+        returncode = process.wait()
+        process.errors.seek(0)
+        err = process.errors.read().strip()
+        process.errors.close()
+        if returncode != 0:
+            raise SSHError('command failed (retcode={}): {}'.format(returncode, err.decode(errors='replace')))
+
+    def scp(self, files, target, mode=None, owner=None):
+        """Same as original `scp` (file-like objects in `files`, `mode` and `owner` are supported)."""
+        self.connect()
+        filenames, tmpdir = self.convert_files_to_filenames(files)
+        try:
+            returncode, _, err = self._communicate(self.scp_command(filenames, target), None)
+            if returncode != 0:
+                raise SSHError(err.strip())
+            targets = self.get_scp_targets(filenames, target)
+            for command, arg in [('chmod', mode), ('chown', owner)]:
+                if arg:
+                    result = self.run(b_quote([command, arg] + targets))
+                    if result.returncode:
+                        raise SSHError(result.stderr.strip())
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class ProgressWriter:
+    """File-like object passing data to `fileobj` and logging amount of transferred data."""
+    def __init__(self, fileobj, logger, step=16 << 20):
+        self.fileobj = fileobj
+        self.logger = logger
+        self.step = step
+        self.bytes = 0
+        self.nextreport = step
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.bytes += len(data)
+        if self.bytes >= self.nextreport:
+            self.logger.info("transferring", bytes=self.bytes)
+            self.nextreport += self.step
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def copystream(source, target):
+    """Copy everything from `source` to `target` file-like objects by chunks."""
+    for chunk in iter(functools.partial(source.read, CHUNKSIZE), b''):
+        target.write(chunk)
+
+
+def getcompression(compression, level=None):
+    """Returns (command compressing stdin to stdout or None, tar options to decompress)."""
+    if compression not in COMPRESSORS:
+        raise ValueError('unknown compression method {!r}, choose one of {}'.format(
+            compression, ', '.join(sorted(COMPRESSORS))))
+    command, tarflags = COMPRESSORS[compression]
+    if command is not None:
+        command = command.format(level=level or DEFAULT_LEVELS[compression])
+    return command, tarflags
+
+
+def pipeline(*commands):
+    """Join shell `commands` (None ones are skipped) into pipeline failing if any of them fails.
+    Pipeline requires bash (see `SSHConnection.bash_command`)."""
+    commands = [command for command in commands if command is not None]
+    if len(commands) == 1:
+        return commands[0]
+    return 'set -o pipefail; ' + ' | '.join(commands)
+
+
+@contextlib.contextmanager
+def compress(fileobj, compression, level=None):
+    """Returns file-like object compressing all written data to `fileobj`."""
+    command, _ = getcompression(compression, level)
+    if command is None:
+        yield fileobj
+    elif compression == 'gzip':
+        with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level or DEFAULT_LEVELS['gzip'], mtime=0) as gz:
+            yield gz
+    else:
+        process = subprocess.Popen(command.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        pump = threading.Thread(target=copystream, args=(process.stdout, fileobj))
+        pump.start()
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+            pump.join()
+            process.stdout.close()
+            if process.wait() != 0:
+                raise SSHError('{} failed (retcode={})'.format(command, process.returncode))
+
+
+@functools.lru_cache(None)
+def getconnection(server, login=None, persist=60):
+    """Returns connection shared by all users of the same server and login."""
+    return SSHConnection(server, login=login, persist=persist)
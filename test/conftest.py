@@ -0,0 +1,16 @@
+import copy
+
+import pytest
+
+from dominator import utils
+
+
+@pytest.fixture(autouse=True)
+def restore_settings():
+    """Restore global settings changed by the test, so tests don't depend on each other."""
+    saved = copy.deepcopy(utils.settings._dict)
+    try:
+        yield utils.settings
+    finally:
+        utils.settings._dict = saved
+        utils.settings.compile()
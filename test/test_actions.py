@@ -122,3 +122,47 @@ def test_makedeb(shipment, tmpdir):
         result = runner.invoke(actions.shipment, ['makedeb', 'test-package', 'trusty', 'high'], obj=shipment)
         assert result.exit_code == 0
         assert os.path.isdir('debian')
+
+
+def test_distribute_transfer(monkeypatch):
+    _settings['images.transfer'] = 'ssh'
+    ships = [entities.Ship('ship{}'.format(i), 'ship{}.example.com'.format(i)) for i in range(2)]
+    images = {'local': entities.Image('local'), 'remote': entities.Image('remote')}
+    containers = []
+    for ship in ships:
+        for name, image in sorted(images.items()):
+            containers.append(entities.Container(name, image))
+            ship.place(containers[-1])
+
+    delivered = []
+    monkeypatch.setattr(entities.Ship, 'hasimage', lambda ship, image: False)
+    monkeypatch.setattr(entities.Image, 'getid', lambda image: 'id' if image.repository == 'local' else None)
+    monkeypatch.setattr(entities.Image, 'deliver', lambda image, targets, check=True: delivered.append(
+        (image.repository, [ship.name for ship in targets])))
+    actions.distribute(containers)
+    # local image is streamed to all ships at once, others are pulled by each ship separately
+    assert sorted(delivered) == [('local', ['ship0', 'ship1']), ('remote', ['ship0']), ('remote', ['ship1'])]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_build_failed_parent(monkeypatch, caplog, ship, jobs):
+    _settings['parallel.jobs'] = jobs
+    base = entities.SourceImage('base', parent=entities.Image('busybox'), scripts=['false'])
+    images = [base, entities.SourceImage('child', parent=base), entities.SourceImage('other', parent=base.parent)]
+    for image in images:
+        ship.place(entities.Container(image.repository, image))
+    shipment = entities.Shipment('test', ships={ship.name: ship})
+
+    built = []
+
+    def build(image, **kwargs):
+        if image is base:
+            raise RuntimeError('build failed')
+        built.append(image.repository)
+    monkeypatch.setattr(entities.SourceImage, 'getid', lambda image, dock=None: None)
+    monkeypatch.setattr(entities.SourceImage, 'build', build)
+    result = CliRunner().invoke(actions.image, ['build'], obj=shipment)
+    # independent images are still built, dependants of the failed one are skipped
+    assert result.exit_code == 1
+    assert built == ['other']
+    assert 'skipping SourceImage(yandex/child' in caplog.text
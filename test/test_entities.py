@@ -0,0 +1,332 @@
+import gc
+import io
+import os
+import pickle
+import shutil
+import tarfile
+import types
+
+import pytest
+
+from dominator import entities
+from dominator import utils
+
+
+class FakeDocker:
+    def __init__(self, containers=()):
+        self.calls = []
+        self.base_url = 'http+unix://fake'
+        self._containers = list(containers)
+
+    def containers(self, all=False):
+        self.calls.append('containers')
+        return self._containers
+
+    def get_image(self, name):
+        self.calls.append('get_image')
+        return io.BytesIO(name.encode() * 100000)
+
+    def load_image(self, chunks):
+        self.calls.append('load_image')
+        self.loaded = b''.join(chunks)
+
+    def inspect_image(self, imageid):
+        self.calls.append('inspect_image')
+        return {'Config': {'Cmd': ['sh', '-c', imageid], 'Env': ['A=1'], 'ExposedPorts': {'80/tcp': {}}}}
+
+    def images(self):
+        self.calls.append('images')
+        return [{'Id': 'id1', 'RepoTags': ['busybox:latest', 'registry:5000/test/busybox:1']},
+                {'Id': 'id2', 'RepoTags': ['<none>:<none>']}, {'Id': 'id3', 'RepoTags': None}]
+
+
+@pytest.fixture
+def ship(monkeypatch):
+    ship = entities.LocalShip()
+    dock = FakeDocker([{'Names': ['/test.cont{}'.format(i)], 'Id': str(i), 'Status': 'Up'} for i in range(10)])
+    monkeypatch.setattr(entities.LocalShip, 'docker', dock)
+    entities.Shipment('test', ships={'local': ship})
+    return ship
+
+
+def test_containers_snapshot(ship):
+    containers = [entities.Container('cont{}'.format(i), entities.Image('busybox')) for i in range(11)]
+    for container in containers:
+        ship.place(container)
+        container.check()
+    assert ship.docker.calls == ['containers']
+    assert [cont.id for cont in containers] == [str(i) for i in range(10)] + [None]
+
+    ship.invalidate_containers()
+    containers[0].check()
+    assert ship.docker.calls == ['containers'] * 2
+
+
+def test_localship_render(ship, tmpdir, restore_settings):
+    restore_settings['configvolumedir'] = str(tmpdir)
+    volume = entities.ConfigVolume('/etc/test', files={
+        'a': entities.TextFile('a'),
+        'sub/b': entities.TextFile('b'),
+    })
+    container = entities.Container('cont', entities.Image('busybox'), volumes={'conf': volume})
+    ship.place(container)
+
+    volume.render(container)
+    assert volume.compare_files() == []
+    inode = os.stat(os.path.join(volume.fullpath, 'a')).st_ino
+
+    volume.files['sub/b'].data = 'c'
+    assert volume.compare_files() == [(('volumes', '/etc/test', 'files', 'sub/b'), ['- b', '+ c'])]
+    volume.render(container)
+    assert volume.compare_files() == []
+    assert os.stat(os.path.join(volume.fullpath, 'a')).st_ino == inode
+    assert sorted(os.listdir(os.path.dirname(volume.fullpath))) == ['test']
+
+    # replaced directory is kept for containers which still have it mounted
+    volume.files['sub/b'].data = 'd'
+    ship.render_volumes([volume], keepold=True)
+    with open(os.path.join(volume.fullpath + '.old', 'sub/b')) as file:
+        assert file.read() == 'c'
+    assert volume.compare_files() == []
+    ship.cleanup_volumes([volume])
+    assert sorted(os.listdir(os.path.dirname(volume.fullpath))) == ['test']
+
+
+def readdir(path):
+    """Returns {relative path: contents} of all files inside the directory."""
+    files = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            with open(os.path.join(dirpath, filename)) as file:
+                files[os.path.relpath(os.path.join(dirpath, filename), path)] = file.read()
+    return files
+
+
+@pytest.fixture
+def remoteship(monkeypatch):
+    """Ship running it's "remote" commands locally."""
+    from dominator.utils import ssh
+    conn = ssh.SSHConnection('ship.example.com')
+    conn.master = True
+    monkeypatch.setattr(conn, 'ssh_command', lambda command, _: ['sh', '-c', command])
+    ship = entities.Ship('ship', 'ship.example.com')
+    monkeypatch.setattr(ship, 'getssh', lambda: conn)
+    return ship
+
+
+def test_ship_upload(remoteship, tmpdir, restore_settings):
+    local, remote = str(tmpdir.join('local')), str(tmpdir.join('remote'))
+
+    def upload(files, keepold=False):
+        shutil.rmtree(local, ignore_errors=True)
+        for name, data in files.items():
+            tmpdir.join('local', name).write(data, ensure=True)
+        remoteship.upload(local, remote, keepold=keepold)
+        return readdir(remote)
+
+    assert upload({'a': '1', 'sub/b': '2'}) == {'a': '1', 'sub/b': '2'}
+    inode = os.stat(os.path.join(remote, 'a')).st_ino
+    assert upload({'a': '1', 'sub/b': '3'}, keepold=True) == {'a': '1', 'sub/b': '3'}
+    assert os.stat(os.path.join(remote, 'a')).st_ino == inode
+    assert readdir(remote + '.old') == {'a': '1', 'sub/b': '2'}
+    remoteship.cleanup_volumes([types.SimpleNamespace(fullpath=remote)])
+    assert sorted(os.listdir(str(tmpdir))) == ['.remote.manifest', 'local', 'remote']
+
+    # files unknown to manifest are not kept
+    tmpdir.join('remote', 'obsolete.conf').write('')
+    remoteship._hashes.clear()
+    tmpdir.join('.remote.manifest').remove()
+    assert upload({'a': '1'}) == {'a': '1'}
+    tmpdir.join('remote', 'obsolete.conf').write('')
+    restore_settings['sync.incremental'] = False
+    assert upload({'a': '2'}) == {'a': '2'}
+
+
+def test_sourceimage_tag_cache(monkeypatch):
+    base = entities.SourceImage('base', parent=entities.Image('busybox'), scripts=['true'], files={'/a': 'a'})
+    child = entities.SourceImage('child', parent=base, env={'A': '1'})
+    tags = base.tag, child.tag
+
+    dumps = []
+    dump = entities.yaml.dump
+    monkeypatch.setattr(entities.yaml, 'dump', lambda obj: dumps.append(obj) or dump(obj))
+    assert (base.tag, child.tag) == tags
+    assert dumps == []
+    assert '_tag' not in dump(child)
+
+    base.scripts.append('false')
+    assert child.tag != tags[1]
+    assert child.tag == child.calculatetag()
+    child.env['A'] = '2'
+    base.scripts.pop()
+    assert base.tag == tags[0]
+    assert child.tag not in tags
+
+
+def test_sourceimage_context_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(entities.Image, 'getid', lambda self, dock=None: 'parentid')
+    image = entities.SourceImage('test', parent=entities.Image('busybox'), files={'/a': 'data'})
+
+    def getnames(compress, cache, cachesize=1):
+        monkeypatch.setattr(utils.settings, 'get', lambda key, default=None: {
+            'build.cache': cache, 'build.cachesize': cachesize}.get(key, default))
+        context = image.gettarfile(compress)
+        with tarfile.open(fileobj=io.BytesIO(b''.join(context))) as tfile:
+            assert tfile.extractfile('Dockerfile').read() == b'FROM busybox:parentid\nADD /a /a\n'
+            return tfile.getnames()
+
+    assert getnames(False, None) == getnames(True, None) == ['/a', 'Dockerfile']
+    assert getnames(False, str(tmpdir)) == getnames(True, str(tmpdir)) == ['/a', 'Dockerfile']
+    assert len(tmpdir.listdir()) == 2
+    monkeypatch.setattr(entities.SourceImage, 'itertarfile', None)
+    assert getnames(True, str(tmpdir)) == ['/a', 'Dockerfile']
+
+    # older contexts are evicted when cache exceeds its size
+    monkeypatch.undo()
+    monkeypatch.setattr(entities.Image, 'getid', lambda self, dock=None: 'parentid')
+    monkeypatch.setattr(utils.settings, 'get', lambda key, default=None: {
+        'build.cache': str(tmpdir), 'build.cachesize': 0}.get(key, default))
+    image.files['/b'] = entities.convert_fileobj('/b', 'b')
+    image.gettarfile(True).close()
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_image_index(monkeypatch):
+    dock = FakeDocker()
+    monkeypatch.setattr(utils, 'getdocker', lambda: dock)
+    images = [entities.Image('busybox'), entities.Image('busybox', tag='1', namespace='test', registry='registry:5000'),
+              entities.Image('busybox', tag='2')]
+    assert [image.getid() for image in images] == ['id1', 'id1', None]
+    assert images[1].gettags(dock) == {'1': 'id1'}
+    assert dock.calls == ['images']
+    utils.invalidate_imageindex(dock)
+    assert images[0].gettags(None) == {'latest': 'id1'}
+    assert dock.calls == ['images'] * 2
+
+
+def test_shipment_images_order():
+    base = entities.Image('busybox')
+    chain = [base]
+    for i in range(5):
+        chain.append(entities.SourceImage('image{}'.format(i), parent=chain[-1]))
+    ship = entities.LocalShip()
+    for i, image in enumerate(reversed(chain)):
+        ship.place(entities.Container('cont{}'.format(i), image))
+    assert entities.Shipment('test', ships={'local': ship}).images == chain
+
+
+def test_ship_hasimage(ship):
+    assert ship.hasimage(entities.Image('busybox'))
+    assert ship.hasimage(entities.Image('busybox', tag='1', namespace='test', registry='registry:5000'))
+    assert not ship.hasimage(entities.Image('busybox', tag='1'))
+    assert ship.docker.calls == ['images']
+
+
+def test_image_transfer(monkeypatch):
+    source = FakeDocker()
+    ships = [entities.LocalShip() for _ in range(3)]
+    targets = {ship: FakeDocker() for ship in ships}
+    monkeypatch.setattr(entities.LocalShip, 'docker', property(targets.get))
+    entities.Image('busybox').transfer(ships, source)
+    assert source.calls == ['get_image']
+    assert all(dock.loaded == b'busybox:latest' * 100000 for dock in targets.values())
+
+
+def test_image_deliver(monkeypatch):
+    from dominator.utils import registry
+    dock = FakeDocker()
+    monkeypatch.setattr(utils, 'getdocker', lambda: dock)
+    calls = []
+
+    def pull(self, dock=None, tag=None):
+        calls.append('pull')
+        if 'push' not in calls:
+            raise entities.docker.errors.DockerException('not found')
+    monkeypatch.setattr(entities.Image, 'pull', pull)
+    monkeypatch.setattr(entities.Image, 'push', lambda self: calls.append('push'))
+    ship = entities.LocalShip()
+
+    # registry could not be checked: pull first, push only when pull fails
+    monkeypatch.setattr(registry, 'hastags', lambda refs: {ref: None for ref in refs})
+    entities.Image('busybox', namespace=None).deliver([ship])
+    assert calls == ['pull', 'push', 'pull']
+    # tag is definitely missing: push right away
+    calls.clear()
+    monkeypatch.setattr(registry, 'hastags', lambda refs: {ref: False for ref in refs})
+    entities.Image('busybox', namespace=None).deliver([ship])
+    assert calls == ['push', 'pull']
+    # image exists only in registry
+    calls[:] = ['push']
+    monkeypatch.setattr(registry, 'hastags', lambda refs: {ref: True for ref in refs})
+    entities.Image('busybox', tag='2', namespace=None).deliver([ship])
+    assert calls == ['push', 'pull']
+
+
+def test_image_inspect_cache(monkeypatch):
+    dock = FakeDocker()
+    monkeypatch.setattr(utils, 'getdocker', lambda: dock)
+    images = [entities.Image('busybox') for _ in range(10)]
+    for image in images:
+        assert image.getcommand() == 'sh -c id1'
+        assert image.getenv() == {'A': '1'}
+        assert image.getports() == [80]
+    assert dock.calls == ['images', 'inspect_image']
+    utils.inspectimage.clear()
+
+
+def test_snapshot():
+    from dominator.utils import snapshot
+    ship = entities.Ship('ship', 'ship.example.com')
+    shipment = entities.Shipment('test', ships={'ship': ship})
+    for i in range(10):
+        volume = entities.ConfigVolume('/etc', files={'a.conf': entities.TextFile(''.join(['text'] * 100))})
+        ship.place(entities.Container('cont{}'.format(i), entities.Image('busybox'),
+                                      env={'KEY': ''.join(['value'] * 100)}, volumes={'config': volume}))
+    data = snapshot.dumps(shipment)
+    assert len(data) < len(pickle.dumps(shipment)) / 2
+
+    loaded = snapshot.load(io.BytesIO(data))
+    containers = list(loaded.containers)
+    assert [cont.name for cont in containers] == ['cont{}'.format(i) for i in range(10)]
+    assert containers[0].env == {'KEY': 'value' * 100} and containers[0].env is not containers[1].env
+    assert containers[0].env['KEY'] is containers[1].env['KEY']
+    assert containers[0].volumes['config'].files['a.conf'].volume.container.ship.shipment is loaded
+    assert list(shipment.containers)[0].env['KEY'] is not list(shipment.containers)[1].env['KEY']
+
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.loads(snapshot.HEADER.pack(snapshot.MAGIC, snapshot.VERSION + 1) + data[snapshot.HEADER.size:])
+
+
+def test_snapshot_lazy(tmpdir):
+    from dominator.utils import snapshot
+    ship = entities.Ship('ship', 'ship.example.com')
+    shipment = entities.Shipment('test', ships={'ship': ship})
+    for i in range(3):
+        volume = entities.ConfigVolume('/etc', files={'a.conf': entities.TextFile(''.join(['text'] * 100))})
+        ship.place(entities.Container('cont{}'.format(i), entities.Image('busybox'), volumes={'config': volume}))
+    path = tmpdir.join('test.snapshot')
+    path.write_binary(snapshot.dumps(shipment))
+
+    loaded = snapshot.loadpath(str(path))
+    volumes = [cont.volumes['config'] for cont in loaded.containers]
+    assert all('_children' not in vars(volume.files) for volume in volumes)
+    assert volumes[0].files['a.conf'].volume is volumes[0]
+    assert volumes[0].files['a.conf'].data is volumes[1].files['a.conf'].data
+    assert '_children' not in vars(volumes[2].files)
+    copy = pickle.loads(pickle.dumps(loaded))
+    assert type(next(copy.containers).volumes['config'].files) is utils.BackrefDict
+    # file is closed as soon as all blobs are read
+    reader = volumes[0].files._loader.__self__
+    assert not reader.close.alive
+
+    loaded = snapshot.loadpath(str(path))
+    finalizer = next(loaded.containers).volumes['config'].files._loader.__self__.close
+    assert finalizer.alive
+    assert snapshot.dumps(shipment) == path.read_binary()
+    shipment.name = 'changed'
+    path.write_binary(snapshot.dumps(shipment))
+    with pytest.raises(snapshot.SnapshotError):
+        next(loaded.containers).volumes['config'].files['a.conf']
+    del loaded
+    gc.collect()
+    assert not finalizer.alive
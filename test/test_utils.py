@@ -0,0 +1,411 @@
+import base64
+import concurrent.futures
+import http.server
+import json
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from dominator import utils
+
+
+def test_parallel_limits():
+    lock = threading.Lock()
+    running = {}
+    maxrunning = {}
+
+    def work(obj):
+        group, _ = obj
+        with lock:
+            running[group] = running.get(group, 0) + 1
+            maxrunning[group] = max(maxrunning.get(group, 0), running[group])
+        time.sleep(0.01)
+        with lock:
+            running[group] -= 1
+        return utils.getcontext('marker')
+
+    objects = [(group, i) for group in 'abc' for i in range(5)]
+    with utils.addcontext(marker='ctx'):
+        results = list(utils.parallel(work, objects, jobs=4, pergroup=2, groupkey=lambda obj: obj[0]))
+    assert sorted(obj for obj, _ in results) == sorted(objects)
+    assert all(future.result() == 'ctx' for _, future in results)
+    assert max(maxrunning.values()) == 2
+
+
+def test_parallel_failfast():
+    def work(obj):
+        if obj == 1:
+            raise RuntimeError()
+
+    for jobs in (1, 2):
+        results = list(utils.parallel(work, range(10), jobs=jobs, failfast=True))
+        assert len(results) < 10
+        assert any(future.exception() is not None for _, future in results)
+
+
+def test_docker_pool(tmpdir, restore_settings):
+    path = str(tmpdir.join('docker.sock'))
+    connections = set()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            connections.add(id(self.connection))
+            body = json.dumps({'Containers': 0}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    server = Server(path, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        restore_settings['docker.pool.size'] = 3
+        dock = utils.getdocker('unix://' + path)
+        assert dock is utils.getdocker('unix://' + path)
+        with concurrent.futures.ThreadPoolExecutor(20) as pool:
+            assert all(info == {'Containers': 0} for info in pool.map(lambda _: dock.info(), range(100)))
+        assert len(connections) <= 3
+    finally:
+        server.shutdown()
+
+
+def test_compress_stream():
+    import gzip
+    import io
+    from dominator.utils import ssh
+
+    data = b'dominator' * 100000
+    target = io.BytesIO()
+    progress = ssh.ProgressWriter(target, utils.getlogger(), step=1024)
+    with ssh.compress(progress, 'gzip', 1) as stream:
+        for i in range(0, len(data), 4096):
+            stream.write(data[i:i + 4096])
+    assert progress.bytes == len(target.getvalue()) < len(data)
+    assert gzip.decompress(target.getvalue()) == data
+
+
+def test_cached():
+    class Obj:
+        def __init__(self):
+            self.calls = 0
+
+        @utils.cached
+        def get(self, arg):
+            self.calls += 1
+            return arg, self.calls
+
+        @utils.cached(ttl=0.1)
+        def expiring(self):
+            self.calls += 1
+            return self.calls
+
+    first, second = Obj(), Obj()
+    assert first.get(1) == first.get(1) == (1, 1)
+    assert second.get(1) == (1, 1)
+    first.get.invalidate(1)
+    assert first.get(1) == (1, 2)
+    assert second.get(1) == (1, 1)
+    assert Obj.get.cache_info() == {'hits': 2, 'misses': 3, 'size': 2}
+
+    Obj.get.clear(lambda obj: obj is second)
+    assert second.get(1) == (1, 2)
+    del first
+    assert Obj.get.cache_info()['size'] == 1
+
+    assert second.expiring() == second.expiring() == 3
+    time.sleep(0.1)
+    assert second.expiring() == 4
+
+
+def test_parallel_dependencies():
+    # diamond with a failing branch: 1 -> (2, 3) -> 4, 3 -> 5
+    deps = {1: [], 2: [1], 3: [1], 4: [2, 3], 5: [3], 6: []}
+    lock = threading.Lock()
+    started = []
+
+    def call(obj):
+        with lock:
+            assert all(dep in started for dep in deps[obj])
+            started.append(obj)
+        time.sleep(0.01)
+        if obj == 2:
+            raise ValueError(obj)
+
+    assert utils.toposort([4, 5, 6, 3, 2, 1], deps.get) == [1, 2, 3, 4, 5, 6]
+    for jobs in 1, 4:
+        started.clear()
+        results = {obj: future.exception() for obj, future in utils.parallel(call, deps, jobs, dependencies=deps.get)}
+        assert sorted(started) == [1, 2, 3, 5, 6]
+        assert isinstance(results.pop(4), utils.DependencyError)
+        assert isinstance(results.pop(2), ValueError)
+        assert set(results.values()) == {None}
+
+
+def test_fanout():
+    def consumer(fail):
+        def consume(chunks):
+            result = []
+            for chunk in chunks:
+                if fail and chunk == 10:
+                    raise ValueError(chunk)
+                result.append(chunk)
+            return result
+        return consume
+
+    futures = utils.fanout(iter(range(100)), [consumer(False), consumer(True), consumer(False)], queuesize=2)
+    assert futures[0].result() == futures[2].result() == list(range(100))
+    assert isinstance(futures[1].exception(), ValueError)
+
+    def chunks():
+        yield from range(10)
+        raise IOError('broken source')
+
+    results = []
+    with pytest.raises(IOError):
+        utils.fanout(chunks(), [lambda chunks: results.append(list(chunks))], queuesize=2)
+    assert not results
+
+
+def test_registry_hastags(monkeypatch, tmpdir):
+    from dominator.utils import registry
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        tags = {'/v2/test/busybox/manifests/1', '/v1/repositories/test/busybox/tags/1',
+                '/v2/private/busybox/manifests/1'}
+        requests = []
+
+        def respond(self, code, body=b'', challenge=None):
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(body)))
+            if code == 401:
+                self.send_header('Www-Authenticate', challenge or
+                                 'Bearer realm="http://{}:{}/token",service="test"'.format(*self.server.server_address))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def do_GET(self):
+            self.requests.append((self.command, self.path))
+            if self.path.startswith('/token'):
+                self.respond(200, json.dumps({'token': 'secret'}).encode())
+            elif self.path.startswith('/v2/'):
+                self.respond(404 if self.server.version == 1 else 200)
+            else:
+                self.respond(200 if self.path in self.tags else 404)
+
+        def do_HEAD(self):
+            self.requests.append((self.command, self.path))
+            if self.path.startswith('/v2/private/'):
+                if self.headers.get('Authorization') != 'Basic ' + base64.b64encode(b'user:pass').decode():
+                    self.respond(401, challenge='Basic realm="test"')
+                else:
+                    self.respond(200 if self.path in self.tags else 404)
+            elif self.headers.get('Authorization') != 'Bearer secret':
+                self.respond(401)
+            else:
+                self.respond(200 if self.path in self.tags else 404)
+
+        def log_message(self, *args):
+            pass
+
+    servers = []
+    for version in 1, 2:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.version = version
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    monkeypatch.setattr(registry, 'geturl', lambda registry: 'http://' + registry)
+    try:
+        refs = [('{}:{}'.format(*server.server_address), 'test/busybox', tag)
+                for server in servers for tag in ('1', '2')]
+        assert registry.hastags(refs + refs, jobs=4) == dict(zip(refs, [True, False, True, False]))
+        assert ('HEAD', '/v2/test/busybox/manifests/2') in Handler.requests
+        assert ('GET', '/v1/repositories/test/busybox/tags/2') in Handler.requests
+
+        # inconclusive checks are reported as None
+        private = ('{}:{}'.format(*servers[1].server_address), 'private/busybox', '1')
+        unreachable = ('127.0.0.1:1', 'test/busybox', '1')
+        assert registry.hastags([private, unreachable]) == {private: None, unreachable: None}
+        config = tmpdir.join('config.json')
+        auth = base64.b64encode(b'user:pass').decode()
+        config.write(json.dumps({'auths': {'http://' + private[0]: {'auth': auth}}}))
+        monkeypatch.setattr(registry, 'DOCKER_CONFIGS', [(str(config), 'auths')])
+        registry.getcredentials.cache_clear()
+        assert registry.hastags([private]) == {private: True}
+    finally:
+        registry.getversion.cache_clear()
+        registry.getcredentials.cache_clear()
+        for server in servers:
+            server.shutdown()
+
+
+def test_builder_pool(monkeypatch):
+    from dominator.utils import builders
+
+    class Dock:
+        def __init__(self, name):
+            self.base_url = name
+            self.images = set()
+
+    class Image:
+        def __init__(self, name, parent=None):
+            self.name = self.tag = name
+            self.parent = parent
+            self.calls = []
+
+        def getid(self, dock):
+            return self.name if self.name in dock.images else None
+
+        def build(self, dock, parents, **kwargs):
+            assert self.parent.name in dock.images
+            dock.images.add(self.name)
+
+        def transfer(self, targets, source):
+            self.calls.append(('transfer', source.base_url))
+            for target in targets:
+                target.images.add(self.name)
+
+        def pull(self, dock, tag):
+            self.calls.append(('pull', dock.base_url))
+            dock.images.add(self.name)
+
+    docks = {url: Dock(url) for url in ('first', 'second')}
+    monkeypatch.setattr(builders, 'getdocker', docks.get)
+    pool = builders.BuilderPool(['first', 'second'])
+    base = Image('base')
+    docks['second'].images.add('base')
+
+    # builder having parent is preferred even if it's busier
+    pool.load[docks['second']] += 1
+    child = Image('child', base)
+    assert pool.build(child) is docks['second']
+    assert pool.locate(child) is docks['second']
+    # otherwise the least loaded one is used and parent is pulled there
+    other = Image('other', Image('busybox'))
+    assert pool.build(other) is docks['first']
+    assert other.parent.calls == [('pull', 'first')]
+    # parent built on other builder is transferred from it
+    pool.prepare(Image('grandchild', child), docks['first'])
+    assert child.calls == [('transfer', 'second')]
+    assert pool.load == {docks['first']: 0, docks['second']: 1}
+
+
+def test_replacefile(tmpdir):
+    path = tmpdir.join('file')
+    utils.replacefile(str(path), b'first')
+    path.chmod(0o640)
+    utils.replacefile(str(path), b'second')
+    assert path.read_binary() == b'second'
+    assert path.stat().mode & 0o777 == 0o640
+    assert tmpdir.listdir() == [path]
+
+
+def test_startup_imports():
+    """CLI startup should not import heavy modules, they are imported lazily when needed."""
+    code = '\n'.join([
+        'import sys',
+        'from dominator.actions import cli',
+        'try:',
+        '    cli(["--help"])',
+        'except SystemExit:',
+        '    pass',
+        'print(sorted(set(sys.modules) & {"docker", "yaml", "mako", "requests", "pkg_resources", "tabloid"}))',
+    ])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    output = subprocess.check_output([sys.executable, '-c', code], env=env, universal_newlines=True)
+    assert output.splitlines()[-1] == '[]'
+
+    yaml = utils.lazyimport('yaml')
+    assert repr(yaml).startswith("<lazy module 'yaml'")
+    assert yaml.safe_load('a: 1') == {'a': 1}
+    assert utils.lazyimport('yaml') is yaml and utils.lazyimport('mako').template.Template
+
+
+def test_settings_cache(tmpdir, monkeypatch):
+    parsed = []
+    yaml = utils.lazyimport('yaml')
+    monkeypatch.setattr(utils, 'yaml', type('yaml', (), {'load': staticmethod(
+        lambda file: parsed.append(file.name) or yaml.safe_load(file))}))
+    tmpdir.join('settings.yaml').write('docker:\n  url: unix:///docker.sock\n  pool: {size: 4}\n')
+
+    def load():
+        settings = utils.Settings()
+        settings.dirpath = str(tmpdir)
+        settings.cachepath = str(tmpdir.join('cache', 'settings.pickle'))
+        settings.load(None)
+        return settings
+
+    settings = load()
+    assert settings.get('docker.pool.size', 10) == 4
+    assert settings.get('docker.timeout', 10) == 10
+    assert settings.get('docker') == {'url': 'unix:///docker.sock', 'pool': {'size': 4}}
+    assert settings.get('')['docker'] is settings.get('.docker.')
+    assert load().get('docker.url') == 'unix:///docker.sock'
+    assert len(parsed) == 1
+
+    tmpdir.join('settings.yaml').write('docker:\n  url: tcp://docker:2375\n')
+    settings = load()
+    assert settings.get('docker.url') == 'tcp://docker:2375'
+    assert len(parsed) == 2
+    settings['docker.pool.size'] = '8'
+    assert settings.get('docker.pool.size', 10) == 8
+    with pytest.raises(utils.NoSuchSetting):
+        settings.get('docker.pool.block')
+
+
+def test_ssh_pipeline():
+    from dominator.utils import ssh
+    assert ssh.pipeline('tar -c .', None) == 'tar -c .'
+    command = ssh.pipeline('cat /nonexistent', 'gzip -c')
+    assert subprocess.run(['bash', '-c', command], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+
+    # commands are run with bash even if login shell is sh
+    conn = ssh.SSHConnection('ship.example.com')
+    conn.master = True
+    conn.ssh_command = lambda command, _: ['sh', '-c', command]
+    process = conn.popen(ssh.pipeline('echo test', 'gzip -c', 'gzip -dc'), stdout=subprocess.PIPE)
+    assert process.stdout.read() == b'test\n'
+    process.stdout.close()
+    ssh.SSHConnection.check(process)
+    process = conn.popen(command)
+    with pytest.raises(ssh.SSHError, match='No such file'):
+        ssh.SSHConnection.check(process)
+
+
+def test_ssh_connect_and_scp(monkeypatch):
+    import io
+    from dominator.utils import ssh
+    conn = ssh.SSHConnection('ship.example.com')
+    commands = []
+    monkeypatch.setattr(conn, '_communicate', lambda command, input: commands.append(command) or (255, b'', b'error'))
+    with pytest.raises(ssh.SSHError):
+        conn.connect()
+    assert not conn.master
+
+    uploaded = []
+
+    def communicate(command, input):
+        commands.append(input)
+        if b'scp' in command[0]:
+            uploaded.extend(open(path, 'rb').read() for path in command[-2:-1])
+        return int(input == b'test -d /tmp/target'), b'', b''
+    monkeypatch.setattr(conn, '_communicate', communicate)
+    conn.scp([io.BytesIO(b'data')], '/tmp/target', mode='0600')
+    assert conn.master and uploaded == [b'data']
+    assert commands[-1] == b'chmod 0600 /tmp/target'
+    conn.master = False